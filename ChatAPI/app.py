@@ -1,22 +1,55 @@
-from groq import Groq
+import anyio
+import asyncio
+from groq import AsyncGroq
 from ulid import ULID
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Depends, Header, HTTPException
 from fastapi.responses import RedirectResponse
 from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from sqlalchemy.orm import Session
 import models
+import maintenance
+import context
+import streaming
 
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-groq_client = Groq()
+groq_client = AsyncGroq()
+background_tasks = set()
 
-def generate_title(user_input: str) -> str:
+def _log_background_exception(task: asyncio.Task) -> None:
+    background_tasks.discard(task)
+    if task.cancelled():
+        return
+    try:
+        task.result()
+    except Exception as exc:
+        print(f"バックグラウンドタスクエラー: {exc}")
+
+def start_background_task(coro) -> asyncio.Task:
+    # 実行中のタスクが途中でGCされないよう参照を保持しておく
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(_log_background_exception)
+    return task
+
+# タイトル生成はキューに積み、応答の開始後にワーカーが処理する
+# 生成待ちかどうかは chats.title_pending に保存し、別のワーカーへのポーリングにも答えられるようにする
+TITLE_WORKERS = 2
+title_queue = asyncio.Queue(maxsize=100)
+# 他のワーカーでのモデルカタログ更新を確認する間隔（秒）
+MODEL_SYNC_INTERVAL = 5
+# DBの整理（maintenance.py）を実行する間隔と、実行時期かどうかを確認する間隔（秒）
+MAINTENANCE_INTERVAL = 24 * 60 * 60
+MAINTENANCE_CHECK_INTERVAL = 60 * 60
+
+async def generate_title(user_input: str) -> str:
     if len(user_input) < 20:
         return user_input
-    response = groq_client.chat.completions.create(
+    response = await groq_client.chat.completions.create(
         model="openai/gpt-oss-20b",
         messages=[
             {"role": "system", "content": "あなたはチャットタイトルを生成するアシスタントです。ユーザーの発言から、20文字以下のタイトルを生成してください。回答はタイトルだけでお願いします。"},
@@ -27,80 +60,205 @@ def generate_title(user_input: str) -> str:
         return response.choices[0].message.content
     return user_input[:20]
 
-async def stream_groq_response(chat_id: str, user_input: str, model_id: int = 1):
-    messages = models.load_messages(chat_id)
-    groq_messages = []
-    for message in messages:
-        if message.role == "reasoning":
-            continue
-        groq_messages.append({
-            "role": message.role,
-            "content": message.content
-        })
-
-    model_name = models.get_model_from_id(model_id)
-    print(f"Using model: {model_name}")
-    stream = groq_client.chat.completions.create(
-        model=model_name,
-        messages=groq_messages,
-        stream=True
-    )
+def enqueue_title(chat_id: str, user_input: str):
+    try:
+        title_queue.put_nowait((chat_id, user_input))
+    except asyncio.QueueFull:
+        # 混雑時は仮タイトルのまま生成待ちを解除する
+        start_background_task(asyncio.to_thread(_save_title, chat_id, user_input[:20]))
+
+def _save_title(chat_id: str, title: str):
+    db = models.SessionLocal()
+    try:
+        models.update_chat_title(db, chat_id, title)
+    finally:
+        db.close()
+
+async def title_worker():
+    while True:
+        chat_id, user_input = await title_queue.get()
+        try:
+            try:
+                title = await generate_title(user_input)
+            except Exception as exc:
+                print(f"タイトル生成エラー ({chat_id}): {exc}")
+                title = user_input[:20]
+            await asyncio.to_thread(_save_title, chat_id, title)
+        except Exception as exc:
+            print(f"タイトル保存エラー ({chat_id}): {exc}")
+        finally:
+            title_queue.task_done()
 
-    reasoning_text = ""
-    response_text = ""
-    for chunk in stream:
-        text = chunk.choices[0].delta.content or ""
-        reasoning = chunk.choices[0].delta.reasoning or ""
-        reasoning_text += reasoning
-        response_text += text
-        yield text
+def _prepare_request(chat_id: str, model_id: int):
+    # コネクションを保持したままスレッドの空きを待つとプールと取り合いになるため、1回のスレッド呼び出しで完結させる
+    db = models.SessionLocal()
+    try:
+        groq_messages, fold_until_id = context.build_context(db, chat_id, model_id)
+        return groq_messages, fold_until_id, models.get_model(model_id).name
+    finally:
+        db.close()
 
-    if reasoning_text:
-        models.save_chat_and_message(chat_id, "", "reasoning", reasoning_text, model_id=model_id)
-    if response_text:
-        models.save_chat_and_message(chat_id, "", "assistant", response_text, model_id=model_id)
+async def stream_groq_response(request: Request, chat_id: str, model_id: int = 1, title_input: str = None):
+    # ストリーミング中はリクエストのセッションが閉じられるため専用のセッションを使う
+    db = models.SessionLocal()
+    stream = None
+    reasoning = streaming.PartialMessage(db, chat_id, "reasoning", model_id)
+    response = streaming.PartialMessage(db, chat_id, "assistant", model_id)
+    completed = False
+    streaming.active_streams.add(chat_id)
+    try:
+        groq_messages, fold_until_id, model_name = await asyncio.to_thread(_prepare_request, chat_id, model_id)
+        if fold_until_id is not None:
+            start_background_task(context.fold_into_summary(groq_client, chat_id, fold_until_id))
+        print(f"Using model: {model_name}")
+        stream = await groq_client.chat.completions.create(
+            model=model_name,
+            messages=groq_messages,
+            stream=True
+        )
+
+        async for chunk in stream:
+            if title_input:
+                # 最初のチャンクを受け取ってからタイトル生成を始め、初回トークンを遅らせない
+                enqueue_title(chat_id, title_input)
+                title_input = None
+            text = chunk.choices[0].delta.content or ""
+            reasoning_text = chunk.choices[0].delta.reasoning or ""
+            reasoning.append(reasoning_text)
+            response.append(text)
+            if reasoning.should_flush() or response.should_flush():
+                # 推論過程を先に保存して表示順（reasoning → assistant）を保つ
+                await reasoning.flush()
+                await response.flush()
+                if await request.is_disconnected():
+                    print(f"クライアント切断のため生成を中断: {chat_id}")
+                    break
+            if reasoning_text:
+                yield "reasoning", reasoning_text
+            if text:
+                yield "content", text
+        else:
+            completed = True
+    finally:
+        # 切断でキャンセルされていても後始末のawaitが中断されないよう保護する
+        with anyio.CancelScope(shield=True):
+            try:
+                if stream is not None:
+                    await stream.close()  # 上流の接続を閉じて生成を止める
+                # 中断時は is_partial=True のまま残し、受信済みの内容を失わない
+                await reasoning.flush(is_partial=not completed)
+                await response.flush(is_partial=not completed)
+            finally:
+                if title_input:
+                    enqueue_title(chat_id, title_input)
+                streaming.active_streams.discard(chat_id)
+                db.close()
+
+async def model_sync_worker():
+    while True:
+        await asyncio.sleep(MODEL_SYNC_INTERVAL)
+        try:
+            if await asyncio.to_thread(models.sync_model_registry):
+                print("モデルカタログを読み直しました")
+        except Exception as exc:
+            print(f"モデルカタログ確認エラー: {exc}")
+
+async def maintenance_worker():
+    while True:
+        await asyncio.sleep(MAINTENANCE_CHECK_INTERVAL)
+        try:
+            await asyncio.to_thread(maintenance.run_if_due, MAINTENANCE_INTERVAL)
+        except Exception as exc:
+            print(f"DB整理エラー: {exc}")
 
 @app.on_event("startup")
 def init_db():
     models.create_db_and_tables()
+    models.sync_model_registry()
+
+@app.on_event("startup")
+async def start_title_workers():
+    for _ in range(TITLE_WORKERS):
+        start_background_task(title_worker())
+    start_background_task(model_sync_worker())
+    start_background_task(maintenance_worker())
 
 @app.get("/")
-async def read_root(request: Request):
-    chats = models.load_chats()
+def read_root(request: Request, db: Session = Depends(models.get_db)):
+    chats = models.load_chats(db)
     ai_models = models.get_models()
     return templates.TemplateResponse("index.html", {"request": request, "page": "Free Chat", "chats": chats, "models": ai_models})
 
 @app.post("/")
-async def chat_endpoint(request: Request):
+async def chat_endpoint(request: Request, db: Session = Depends(models.get_db)):
     chat_id = str(ULID())
-    return await post_chat(request, chat_id)
+    return await post_chat(request, chat_id, db)
 
 @app.get("/c/{chat_id}")
-async def get_chat(request: Request, chat_id: str):
-    if not models.chat_exists(chat_id):
+def get_chat(request: Request, chat_id: str, db: Session = Depends(models.get_db)):
+    page = models.load_chat_page(db, chat_id)
+    if page is None:
         return RedirectResponse(url="/", status_code=303)
-    messages = models.load_messages(chat_id)
-    chats = models.load_chats()
-    title = models.get_chat_title(chat_id)
-    ai_models = models.get_models()
-    return templates.TemplateResponse("index.html", {"request": request, "page": title, "chats": chats, "messages": messages, "models": ai_models})
+    # 中断されたまま残った応答には追従しない（他のワーカーのストリームは保存時刻で判定する）
+    reply_streaming = chat_id in streaming.active_streams or models.is_reply_streaming(db, chat_id, streaming.STALE_STREAM_TIMEOUT)
+    return templates.TemplateResponse("index.html", {"request": request, "page": page["title"], "chats": page["chats"], "messages": page["messages"], "has_older": page["has_older"], "models": page["models"], "title_pending": page["title_pending"], "reply_streaming": reply_streaming})
+
+@app.get("/c/{chat_id}/title")
+def get_title(chat_id: str, db: Session = Depends(models.get_db)):
+    return {"title": models.get_chat_title(db, chat_id), "pending": models.is_title_pending(db, chat_id)}
+
+@app.get("/c/{chat_id}/messages")
+def get_older_messages(request: Request, chat_id: str, before_id: int, db: Session = Depends(models.get_db)):
+    messages, has_older = models.load_message_page(db, chat_id, before_id=before_id)
+    return templates.TemplateResponse("_messages.html", {"request": request, "messages": messages, "has_older": has_older})
+
+def _save_user_message(db: Session, chat_id: str, user_input: str, model_id: int):
+    """ユーザーの入力を保存し、タイトルを生成する入力を返す（生成しなければNone）"""
+    # 新規チャットは仮タイトルで保存し、長い入力のタイトルは応答開始後に生成する
+    title = ""
+    title_input = None
+    if not models.chat_exists(db, chat_id):
+        title = user_input[:20]
+        if len(user_input) >= 20:
+            title_input = user_input
+    models.save_chat_and_message(db, chat_id, title, "user", user_input, model_id=model_id, title_pending=title_input is not None)
+    return title_input
 
 @app.post("/c/{chat_id}")
-async def post_chat(request: Request, chat_id: str):
+async def post_chat(request: Request, chat_id: str, db: Session = Depends(models.get_db)):
     form_data = await request.form()
     user_input = form_data['user_input']
-    model_id = form_data['model_select']
+    try:
+        model_id = int(form_data['model_select'])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=400, detail="不明なモデルです")
+    if models.get_model(model_id) is None:
+        raise HTTPException(status_code=400, detail="不明なモデルです")
 
-    title = ""
-    if not models.chat_exists(chat_id):
-        title = generate_title(user_input)
-    models.save_chat_and_message(chat_id, title, "user", user_input, model_id=model_id)
+    title_input = await asyncio.to_thread(_save_user_message, db, chat_id, user_input, model_id)
+
+    generator = streaming.encode_sse(stream_groq_response(request, chat_id, model_id=model_id, title_input=title_input))
+    headers = {"X-Chat-Id": chat_id, **streaming.SSE_HEADERS}
+    return StreamingResponse(generator, media_type='text/event-stream', headers=headers)
 
-    generator = stream_groq_response(chat_id, user_input, model_id=model_id)
-    headers = {"X-Chat-Id": chat_id}
+@app.get("/c/{chat_id}/resume")
+async def resume_chat(chat_id: str, last_event_id: str | None = Header(default=None)):
+    offsets = streaming.parse_last_event_id(last_event_id)
+    generator = streaming.encode_sse(streaming.resume_reply(chat_id, offsets), offsets)
+    headers = {"X-Chat-Id": chat_id, **streaming.SSE_HEADERS}
     return StreamingResponse(generator, media_type='text/event-stream', headers=headers)
 
+@app.get("/stats/cache")
+async def cache_stats():
+    return models.sidebar_cache_stats
+
+@app.post("/models/reload")
+async def reload_models():
+    # modelsテーブルを編集した後に呼び出してカタログを読み直す（他のワーカーはMODEL_SYNC_INTERVAL以内に追従する）
+    await asyncio.to_thread(models.reload_model_catalog)
+    return {"models": len(models.get_models())}
+
 @app.get("/delete/{chat_id}")
-async def delete_chat(chat_id: str):
-    models.delete_chat(chat_id)
+def delete_chat(chat_id: str, db: Session = Depends(models.get_db)):
+    models.delete_chat(db, chat_id)
     return RedirectResponse(url="/", status_code=303)
\ No newline at end of file
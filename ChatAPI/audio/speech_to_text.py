@@ -1,6 +1,7 @@
 import streamlit as st
-from groq import Groq
+from page_resources import get_groq_client
 from io import BytesIO
+from audio_chunks import TRANSCRIPTION_MAX_BYTES, split_audio, transcribe_chunks, stitch
 
 PAGE_TITLE = "Speech To Text"
 st.set_page_config(
@@ -11,7 +12,7 @@ st.set_page_config(
 )
 st.title(PAGE_TITLE)
 
-client = Groq()
+client = get_groq_client()
 MODEL_OPTIONS = ("whisper-large-v3", "whisper-large-v3-turbo")
 LANGUAGE_OPTIONS = (None, 'en', 'ja')
 model = st.radio("model", MODEL_OPTIONS)
@@ -21,13 +22,33 @@ temperature = st.slider("temperature", 0.0, 1.0, value=0.0)
 uploaded_file = st.file_uploader("音声ファイルをアップロード")
 
 if uploaded_file is not None:
-    audio_file = BytesIO(uploaded_file.getvalue())
-    audio_file.name = uploaded_file.name
-    transcription = client.audio.transcriptions.create(
-        file=audio_file,
-        model=model,
-        language=language,
-        temperature=temperature,
-        response_format="verbose_json",
-    )
-    st.write(transcription.text)
\ No newline at end of file
+    options = {"model": model, "language": language, "temperature": temperature}
+    chunks = split_audio(uploaded_file.getvalue(), uploaded_file.name)
+    if chunks is None and uploaded_file.size > TRANSCRIPTION_MAX_BYTES:
+        # 分割できない形式（ffmpegがない環境のWAV以外など）で上限を超えると、APIに送っても受け付けられない
+        st.warning(
+            f"ファイルが {TRANSCRIPTION_MAX_BYTES // (1024 * 1024)}MB を超えていて、この形式は分割できないため文字起こしできません。"
+            "WAVに変換するか、短く分けてアップロードしてください。"
+        )
+        st.stop()
+    if chunks is None or len(chunks) == 1:
+        # 短い音声や分割できない形式は、ファイル全体を1回で送る
+        audio_file = BytesIO(uploaded_file.getvalue())
+        audio_file.name = uploaded_file.name
+        with st.spinner("文字起こし中..."):
+            transcription = client.audio.transcriptions.create(
+                file=audio_file,
+                response_format="verbose_json",
+                **options,
+            )
+        st.write(transcription.text)
+    else:
+        # 終わったチャンクから順に表示する
+        progress = st.progress(0.0, text=f"0 / {len(chunks)} チャンク")
+        placeholder = st.empty()
+        results = {}
+        for index, segments in transcribe_chunks(client, chunks, **options):
+            results[index] = segments
+            progress.progress(len(results) / len(chunks), text=f"{len(results)} / {len(chunks)} チャンク")
+            placeholder.write(stitch(results, len(chunks)))
+        progress.empty()
\ No newline at end of file
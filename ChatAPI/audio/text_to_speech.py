@@ -1,9 +1,9 @@
 import io
 import wave
 import streamlit as st
-from groq import Groq
-from google import genai
 from google.genai import types
+from tts_cache import AudioCache
+from page_resources import get_groq_client, get_genai_client
 
 # ページ設定
 PAGE_TITLE = "Text To Speech"
@@ -16,8 +16,13 @@ st.set_page_config(
 st.title(PAGE_TITLE)
 
 # クライアント初期化
-groq_client = Groq()
-gen_client = genai.Client()
+groq_client = get_groq_client()
+gen_client = get_genai_client()
+
+@st.cache_resource
+def get_audio_cache():
+    # free_chat.py と同じディレクトリを使い、同じ内容の音声を共有する
+    return AudioCache()
 
 def wave_file_bytes(pcm, channels=1, rate=24000, sample_width=2):
     """PCMデータをWAVバイト列に変換"""
@@ -95,6 +100,11 @@ def select_model_and_voice():
 
 def generate_audio(model, voice, content, response_format="wav"):
     """選択モデルに応じて音声データを生成し、バイト列を返す"""
+    audio_cache = get_audio_cache()
+    key = audio_cache.key(model, voice, content)
+    audio_bytes = audio_cache.get(key)
+    if audio_bytes is not None:
+        return audio_bytes
     if model == "playai-tts":
         response = groq_client.audio.speech.create(
             model=model,
@@ -120,6 +130,7 @@ def generate_audio(model, voice, content, response_format="wav"):
         )
         blob = response.candidates[0].content.parts[0].inline_data.data
         audio_bytes = wave_file_bytes(blob)
+    audio_cache.put(key, audio_bytes)
     return audio_bytes
 
 @st.fragment
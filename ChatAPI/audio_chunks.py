@@ -0,0 +1,162 @@
+"""長い音声を無音で区切って並行して文字起こしする
+
+音声を CHUNK_SECONDS ごとに区切り、区切り位置は手前 SILENCE_SEARCH_SECONDS の範囲で、SILENCE_WINDOW_SECONDS の
+平均音量が最も小さい箇所（単語の間ではなく文の切れ目になりやすい）の中央にする。
+各チャンクは前後に OVERLAP_SECONDS ずつ重ねて送り、境界の単語が欠けないようにする。重なった部分は
+返ってきたセグメントの時刻で振り分け、中心がそのチャンク本来の区間にあるセグメントだけを残す。
+文字起こしは最大 TRANSCRIBE_WORKERS 件を並行して行い、終わったチャンクから順に返す。
+
+WAVは標準ライブラリで読み、それ以外の形式は ffmpeg があれば16kHzモノラルに変換して読む
+（どちらもできなければ split_audio() は None を返すので、呼び出し側はファイル全体を1回で送る）。
+"""
+import io
+import os
+import wave
+import shutil
+import tempfile
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+
+CHUNK_SECONDS = 120
+OVERLAP_SECONDS = 2
+SILENCE_SEARCH_SECONDS = 15
+FRAME_SECONDS = 0.05  # 無音を探すときの音量の計算単位
+SILENCE_WINDOW_SECONDS = 0.5
+TRANSCRIBE_WORKERS = 4
+FFMPEG_SAMPLE_RATE = 16000
+TRANSCRIPTION_MAX_BYTES = 25 * 1024 * 1024  # 1回のリクエストで送れる音声ファイルの上限
+
+# start・end はチャンク本来の区間、offset は送る音声（重なりを含む）の開始位置（いずれも秒）
+AudioChunk = namedtuple("AudioChunk", ["start", "end", "offset", "wav"])
+
+def _read_wav(data: bytes):
+    """WAVをモノラルのint16配列とサンプリング周波数にする（読めなければNone）"""
+    try:
+        with wave.open(io.BytesIO(data)) as wf:
+            channels, width, rate = wf.getnchannels(), wf.getsampwidth(), wf.getframerate()
+            frames = wf.readframes(wf.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    if width == 1:
+        samples = (np.frombuffer(frames, np.uint8).astype(np.int32) - 128) << 8
+    elif width == 2:
+        samples = np.frombuffer(frames, "<i2").astype(np.int32)
+    elif width == 3:
+        raw = np.frombuffer(frames, np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((raw[:, 0] << 8) | (raw[:, 1] << 16) | (raw[:, 2] << 24)) >> 16
+    elif width == 4:
+        samples = np.frombuffer(frames, "<i4") >> 16
+    else:
+        return None
+    samples = samples.reshape(-1, channels).mean(axis=1)
+    return samples.astype(np.int16), rate
+
+def _decode_ffmpeg(data: bytes, filename: str):
+    """ffmpegで16kHzモノラルのint16配列にする（ffmpegがないか失敗したらNone）"""
+    if shutil.which("ffmpeg") is None:
+        return None
+    # m4aなどはファイル末尾の情報が必要で、パイプからは読めないため一時ファイルに書く
+    with tempfile.NamedTemporaryFile(suffix=os.path.splitext(filename)[1]) as f:
+        f.write(data)
+        f.flush()
+        result = subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-i", f.name,
+             "-f", "s16le", "-ac", "1", "-ar", str(FFMPEG_SAMPLE_RATE), "pipe:1"],
+            capture_output=True,
+        )
+    if result.returncode != 0:
+        print(f"ffmpegで変換できませんでした: {result.stderr.decode(errors='replace')}")
+        return None
+    return np.frombuffer(result.stdout, "<i2"), FFMPEG_SAMPLE_RATE
+
+def _to_wav(samples, rate: int) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(samples.tobytes())
+    return buf.getvalue()
+
+def split_on_silence(samples, rate: int, chunk_seconds: float = CHUNK_SECONDS,
+                     search_seconds: float = SILENCE_SEARCH_SECONDS) -> list:
+    """区切り位置（サンプル番号）の一覧を返す（先頭の0と末尾を含む）"""
+    frame = max(1, int(rate * FRAME_SECONDS))
+    n_frames = len(samples) // frame
+    energy = np.square(samples[:n_frames * frame].astype(np.float32)).reshape(n_frames, frame).mean(axis=1)
+    window = max(1, int(SILENCE_WINDOW_SECONDS / FRAME_SECONDS))
+    energy = np.convolve(energy, np.ones(window) / window, mode="same")
+    chunk_length = int(rate * chunk_seconds)
+    search_frames = max(1, int(search_seconds / FRAME_SECONDS))
+    cuts = [0]
+    while len(samples) - cuts[-1] > chunk_length:
+        last_frame = (cuts[-1] + chunk_length) // frame
+        first_frame = max(cuts[-1] // frame + 1, last_frame - search_frames)
+        quietest = first_frame + int(np.argmin(energy[first_frame:last_frame]))
+        cuts.append(quietest * frame + frame // 2)
+    cuts.append(len(samples))
+    return cuts
+
+def split_audio(data: bytes, filename: str = "", chunk_seconds: float = CHUNK_SECONDS,
+                overlap_seconds: float = OVERLAP_SECONDS) -> list:
+    """音声ファイルをAudioChunkの一覧に分ける（読めない形式ならNone）"""
+    decoded = _read_wav(data) or _decode_ffmpeg(data, filename)
+    if decoded is None:
+        return None
+    samples, rate = decoded
+    cuts = split_on_silence(samples, rate, chunk_seconds)
+    overlap = int(rate * overlap_seconds)
+    chunks = []
+    for start, end in zip(cuts, cuts[1:]):
+        first, last = max(0, start - overlap), min(len(samples), end + overlap)
+        chunks.append(AudioChunk(start / rate, end / rate, first / rate, _to_wav(samples[first:last], rate)))
+    return chunks
+
+def _segment_value(segment, key):
+    # verbose_jsonのセグメントはSDKによって辞書のままのことがある
+    return segment[key] if isinstance(segment, dict) else getattr(segment, key)
+
+def _transcribe_chunk(client, index: int, chunk: AudioChunk, options: dict) -> list:
+    """チャンクを文字起こしし、本来の区間に中心がある (開始秒, 終了秒, テキスト) を返す"""
+    transcription = client.audio.transcriptions.create(
+        file=(f"chunk_{index}.wav", chunk.wav),
+        response_format="verbose_json",
+        **options,
+    )
+    segments = getattr(transcription, "segments", None)
+    if not segments:
+        return [(chunk.start, chunk.end, transcription.text)] if transcription.text else []
+    kept = []
+    for segment in segments:
+        start = chunk.offset + _segment_value(segment, "start")
+        end = chunk.offset + _segment_value(segment, "end")
+        if chunk.start <= (start + end) / 2 < chunk.end:
+            kept.append((start, end, _segment_value(segment, "text")))
+    return kept
+
+def transcribe_chunks(client, chunks, workers: int = TRANSCRIBE_WORKERS, **options):
+    """チャンクを並行して文字起こしし、終わった順に (番号, セグメント一覧) を返す
+
+    optionsは transcriptions.create() にそのまま渡す（model・language・temperatureなど）。
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transcribe") as pool:
+        futures = {pool.submit(_transcribe_chunk, client, i, chunk, options): i for i, chunk in enumerate(chunks)}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            # 途中で失敗・中断したら、まだ始まっていないチャンクは送らない
+            for future in futures:
+                future.cancel()
+
+def stitch(results: dict, count: int, pending: str = "…") -> str:
+    """チャンク番号ごとのセグメントを時刻順につなげる（まだ終わっていないチャンクはpendingで示す）"""
+    parts = []
+    for index in range(count):
+        if index not in results:
+            parts.append(pending)
+            continue
+        parts.extend(text for _, _, text in sorted(results[index]))
+    return "".join(parts).strip()
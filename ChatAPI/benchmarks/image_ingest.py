@@ -0,0 +1,81 @@
+"""添付画像の取り込みにかかる時間と保存されるサイズを計測するベンチマーク
+
+スマートフォンの写真に近い12MP（4032x3024）のJPEGを作り、以前のページの処理
+（Image.open → thumbnail((1920, 1920)) → 既定品質でJPEG保存）と ingest_image() を比べる。
+写真は品質92、半数はEXIFで90度回転（縦持ち）にする。
+
+使い方（ChatAPIディレクトリで実行）:
+    uv run python benchmarks/image_ingest.py --photos 6 --repeat 3
+"""
+import io
+import os
+import sys
+import time
+import random
+import argparse
+import statistics
+
+from PIL import Image, ImageFilter, ExifTags
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_ingest import ingest_image
+
+
+def make_photo(seed: int, portrait: bool) -> bytes:
+    """ぼかしたノイズにグラデーションと粒状のノイズを重ねた、写真に近い圧縮率のJPEG"""
+    random.seed(seed)
+    size = (4032, 3024)
+    base = Image.effect_noise((size[0] // 16, size[1] // 16), 80).resize(size, Image.Resampling.BICUBIC)
+    gradient = Image.linear_gradient("L").resize(size).rotate(random.choice([0, 90, 180]), expand=False)
+    channels = [Image.blend(base, gradient, random.random()).filter(ImageFilter.GaussianBlur(2)) for _ in range(3)]
+    image = Image.merge("RGB", channels)
+    grain = Image.effect_noise(size, 12).convert("RGB")
+    image = Image.blend(image, grain, 0.15)
+    exif = Image.Exif()
+    exif[ExifTags.Base.Orientation] = 6 if portrait else 1
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=92, exif=exif)
+    return buf.getvalue()
+
+
+def legacy_ingest(data: bytes) -> bytes:
+    """以前の free_chat.py・openai_chat.py の処理（EXIFの向きは無視される）"""
+    image = Image.open(io.BytesIO(data))
+    if image.width > 1920 or image.height > 1920:
+        image.thumbnail((1920, 1920))
+    image_bytes = io.BytesIO()
+    if image.mode == "RGBA":
+        image = image.convert("RGB")
+    image.save(image_bytes, format="JPEG")
+    return image_bytes.getvalue()
+
+
+def measure(func, photos, repeat: int):
+    times = []
+    sizes = []
+    for data in photos:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            out = func(data)
+            times.append(time.perf_counter() - start)
+        sizes.append(len(out))
+    return statistics.median(times), statistics.mean(sizes), out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--photos", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    photos = [make_photo(i, portrait=i % 2 == 1) for i in range(args.photos)]
+    print(f"入力: {args.photos}枚、平均 {statistics.mean(map(len, photos)) / 1e6:.2f}MB")
+    for label, func in (("以前の処理", legacy_ingest), ("ingest_image", lambda data: ingest_image(data)[0])):
+        median, size, out = measure(func, photos, args.repeat)
+        with Image.open(io.BytesIO(out)) as image:
+            shape = f"{image.width}x{image.height}"
+        print(f"{label:<14} 中央値 {median * 1000:7.1f}ms  出力 平均{size / 1024:7.1f}KB  最後の写真 {shape}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""ストリーミング応答の描画で送られるフロントエンドへのメッセージ数とバイト数を計測するベンチマーク
+
+約2,000トークンの応答（段落とコードブロックを含むMarkdown）を一定の速度で受け取ったとして、
+チャンクごとに全文を placeholder.markdown() する従来の方法と StreamRenderer を比べる。
+描画のたびにStreamlitが送るMarkdown要素のprotobufを作り、そのサイズを合計する。
+時刻は疑似クロックで進めるため、実際には待たない。
+
+使い方（ChatAPIディレクトリで実行）:
+    uv run python benchmarks/render_messages.py --tokens 2000 --rate 300
+"""
+import os
+import sys
+import argparse
+
+from streamlit.proto.Markdown_pb2 import Markdown
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stream_render import StreamRenderer
+
+
+class Recorder:
+    """送られる要素の数とprotobufのバイト数を数える、st.container() の代わり"""
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+
+    def empty(self):
+        return self
+
+    def markdown(self, body):
+        self.messages += 1
+        self.bytes += Markdown(body=body).ByteSize()
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_chunks(tokens: int):
+    """Markdownの応答を1トークンずつのチャンクに分ける"""
+    chunks = []
+    for i in range(tokens):
+        if i % 400 == 200:
+            chunks.append("\n\n```python\n")
+        elif i % 400 == 260:
+            chunks.append("\n```\n\n")
+        elif i % 60 == 59:
+            chunks.append(f"単語{i}。\n\n")
+        elif 200 < i % 400 < 260:
+            chunks.append(f"x{i} = {i}\n")
+        else:
+            chunks.append(f"単語{i} ")
+    return chunks
+
+
+def run_naive(chunks):
+    recorder = Recorder()
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        recorder.markdown(text)
+    return recorder
+
+
+def run_renderer(chunks, rate: float, interval: float):
+    recorder = Recorder()
+    clock = Clock()
+    renderer = StreamRenderer(recorder, interval=interval, clock=clock)
+    for chunk in chunks:
+        clock.now += 1 / rate
+        renderer.write(chunk)
+    renderer.flush()
+    assert renderer.text == "".join(chunks)
+    return recorder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=300, help="1秒あたりに受け取るトークン数")
+    parser.add_argument("--intervals", type=float, nargs="+", default=[0.05, 0.08, 0.1])
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.tokens)
+    total = len("".join(chunks).encode())
+    print(f"tokens={args.tokens}  rate={args.rate:.0f}/s  answer={total / 1024:.1f}KB")
+    results = [("naive", run_naive(chunks))]
+    for interval in args.intervals:
+        results.append((f"interval={interval}", run_renderer(chunks, args.rate, interval)))
+    for name, recorder in results:
+        print(f"{name:15s}  messages={recorder.messages:5d}  bytes={recorder.bytes / 1024:10.1f}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""複数ワーカーから save_chat_and_message を同時に呼び出し、SQLiteの書き込みスループットを計測するベンチマーク
+
+本番の複数ワーカー構成を模して、プロセスごとにスレッドを立てて
+ユーザー発言の保存・応答の保存・サイドバーの読み込みを繰り返す。
+--mode default はPRAGMAを設定しない従来の接続、wal は models.engine（WAL + busy_timeout + synchronous=NORMAL）。
+
+使い方（ChatAPIディレクトリで実行）:
+    uv run python benchmarks/sqlite_writes.py --workers 1 4 8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+CHATAPI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_models(database_url: str):
+    os.environ["CHAT_DATABASE_URL"] = database_url
+    sys.path.insert(0, CHATAPI_DIR)
+    import models
+    return models
+
+
+def prepare_database(database_url: str, mode: str):
+    models = _import_models(database_url)
+    if mode == "wal":
+        models.create_db_and_tables()
+    else:
+        from sqlalchemy import create_engine
+        models.Base.metadata.create_all(bind=create_engine(database_url))
+
+
+def run_worker(database_url: str, mode: str, worker: int, threads: int, writes: int, start_at: float, results):
+    models = _import_models(database_url)
+    if mode == "wal":
+        session_factory = models.SessionLocal
+    else:
+        from sqlalchemy import create_engine
+        from sqlalchemy.orm import sessionmaker
+        engine = create_engine(database_url, connect_args={"check_same_thread": False}, pool_size=threads)
+        session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    counts = {"ok": 0, "locked": 0, "error": 0}
+    lock = threading.Lock()
+
+    def run_thread(thread: int):
+        db = session_factory()
+        try:
+            for i in range(writes):
+                chat_id = f"bench-{worker}-{thread}-{i // 10}"
+                try:
+                    models.save_chat_and_message(db, chat_id, "ベンチマーク", "user", f"質問 {i}")
+                    models.add_message(db, chat_id, "assistant", f"回答 {i} " * 20)
+                    models.load_chats(db)
+                    key = "ok"
+                except Exception as exc:
+                    db.rollback()
+                    key = "locked" if "database is locked" in str(exc) else "error"
+                with lock:
+                    counts[key] += 1
+        finally:
+            db.close()
+
+    # 全ワーカーの準備が揃ってから一斉に書き込みを始める
+    time.sleep(max(start_at - time.time(), 0))
+    pool = [threading.Thread(target=run_thread, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    results.put(counts)
+
+
+def run_level(mode: str, workers: int, threads: int, writes: int):
+    tmpdir = tempfile.mkdtemp()
+    database_url = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    ctx = multiprocessing.get_context("spawn")
+    # modelsはimport時のDATABASE_URLでエンジンを作るため、準備も別プロセスで行う
+    prep = ctx.Process(target=prepare_database, args=(database_url, mode))
+    prep.start()
+    prep.join()
+
+    results = ctx.Queue()
+    start_at = time.time() + 5
+    procs = [
+        ctx.Process(target=run_worker, args=(database_url, mode, w, threads, writes, start_at, results))
+        for w in range(workers)
+    ]
+    for p in procs:
+        p.start()
+    totals = {"ok": 0, "locked": 0, "error": 0}
+    for _ in procs:
+        for key, value in results.get().items():
+            totals[key] += value
+    elapsed = time.time() - start_at
+    for p in procs:
+        p.join()
+
+    print(f"mode={mode:7s}  workers={workers:2d}  turns ok={totals['ok']:6d}  locked={totals['locked']:4d}  "
+          f"error={totals['error']:4d}  {totals['ok'] / elapsed:8.1f} turns/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--threads", type=int, default=4, help="ワーカーごとのスレッド数")
+    parser.add_argument("--writes", type=int, default=100, help="スレッドごとのターン数")
+    parser.add_argument("--mode", choices=["default", "wal", "both"], default="both")
+    args = parser.parse_args()
+
+    modes = ["default", "wal"] if args.mode == "both" else [args.mode]
+    for workers in args.workers:
+        for mode in modes:
+            run_level(mode, workers, args.threads, args.writes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""ローカルの疑似Groqサーバーに対してチャットの同時ストリーミングを計測するベンチマーク
+
+使い方（ChatAPIディレクトリで実行）:
+    uv run python benchmarks/stream_ttft.py --concurrency 1 10 50
+"""
+import os
+import sys
+import time
+import json
+import socket
+import asyncio
+import argparse
+import tempfile
+import statistics
+import multiprocessing
+
+import httpx
+import uvicorn
+
+CHATAPI_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_fake_groq(port: int, tokens: int, delay: float):
+    """OpenAI互換のchat.completionsをSSEで返す疑似Groqサーバー"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse, JSONResponse
+
+    fake = FastAPI()
+
+    def chunk(content=None, finish_reason=None):
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "bench",
+            "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}],
+        }
+
+    @fake.post("/openai/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        if not body.get("stream"):
+            return JSONResponse({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "bench",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "ベンチマーク"}, "finish_reason": "stop"}],
+            })
+
+        async def events():
+            for i in range(tokens):
+                await asyncio.sleep(delay)
+                yield f"data: {json.dumps(chunk(f'token{i} '))}\n\n"
+            yield f"data: {json.dumps(chunk(finish_reason='stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    uvicorn.run(fake, host="127.0.0.1", port=port, log_level="warning")
+
+
+def run_app(port: int, groq_port: int, database_url: str):
+    os.chdir(CHATAPI_DIR)
+    sys.path.insert(0, CHATAPI_DIR)
+    os.environ["GROQ_BASE_URL"] = f"http://127.0.0.1:{groq_port}"
+    os.environ["GROQ_API_KEY"] = "bench"
+    os.environ["CHAT_DATABASE_URL"] = database_url
+    uvicorn.run("app:app", host="127.0.0.1", port=port, log_level="warning")
+
+
+def prepare_database(database_url: str):
+    os.environ["CHAT_DATABASE_URL"] = database_url
+    sys.path.insert(0, CHATAPI_DIR)
+    import models
+    models.create_db_and_tables()
+    db = models.SessionLocal()
+    db.add(models.models(id=1, name="bench-model", display="Bench"))
+    db.commit()
+    db.close()
+
+
+async def wait_ready(url: str):
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"サーバーが起動しませんでした: {url}")
+
+
+async def one_chat(client: httpx.AsyncClient, url: str, prompt: str):
+    start = time.perf_counter()
+    ttft = None
+    data = {"user_input": prompt, "model_select": "1"}
+    async with client.stream("POST", url, data=data) as res:
+        async for chunk in res.aiter_bytes():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+    return ttft, time.perf_counter() - start
+
+
+async def run_level(base_url: str, concurrency: int):
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        # 20文字以上の入力でタイトル生成のラウンドトリップも含めて計測する
+        prompt = "ベンチマーク用の長めの質問文です。タイトル生成も発生させます。"
+        results = await asyncio.gather(*(one_chat(client, f"{base_url}/", prompt) for _ in range(concurrency)))
+    ttfts = sorted(r[0] for r in results if r[0] is not None)
+    totals = [r[1] for r in results]
+    p95 = ttfts[max(0, int(len(ttfts) * 0.95) - 1)]
+    print(f"concurrency={concurrency:3d}  ttft median={statistics.median(ttfts)*1000:8.1f}ms  "
+          f"p95={p95*1000:8.1f}ms  max={ttfts[-1]*1000:8.1f}ms  total max={max(totals):6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--tokens", type=int, default=50)
+    parser.add_argument("--delay", type=float, default=0.02, help="疑似Groqのトークン間隔（秒）")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    database_url = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+    prepare_database(database_url)
+
+    groq_port, app_port = _free_port(), _free_port()
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=run_fake_groq, args=(groq_port, args.tokens, args.delay), daemon=True),
+        ctx.Process(target=run_app, args=(app_port, groq_port, database_url), daemon=True),
+    ]
+    for p in procs:
+        p.start()
+    try:
+        base_url = f"http://127.0.0.1:{app_port}"
+        asyncio.run(wait_ready(base_url))
+        for level in args.concurrency:
+            asyncio.run(run_level(base_url, level))
+    finally:
+        for p in procs:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
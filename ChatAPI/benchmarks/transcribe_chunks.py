@@ -0,0 +1,124 @@
+"""長い音声の文字起こしにかかる時間を、1回で送る場合とチャンクに分けて並行する場合で比べるベンチマーク
+
+音声は「単語」（周波数で番号がわかる0.6秒の音）を並べたWAVで、文の間に長めの無音を入れる。
+APIの代わりに、音声の長さに比例して待ってから単語を聞き取るクライアントを使うため、
+つなぎ合わせた結果に単語の欠けや重複がないかも確かめられる。
+
+使い方（ChatAPIディレクトリで実行）:
+    uv run python benchmarks/transcribe_chunks.py --minutes 20 --speed 300 --workers 4
+"""
+import io
+import os
+import sys
+import time
+import wave
+import random
+import argparse
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from audio_chunks import split_audio, transcribe_chunks, stitch
+
+RATE = 16000
+WORD_SECONDS = 0.6
+WORD_IDS = 40  # 単語の周波数は 300 + 20 * (番号 % WORD_IDS) Hz
+
+
+def make_audio(minutes: float):
+    """単語と無音を並べたWAVと、単語の番号の並びを返す"""
+    random.seed(0)
+    parts, words = [], []
+    length = 0
+    t = np.arange(int(RATE * WORD_SECONDS)) / RATE
+    while length < minutes * 60 * RATE:
+        for _ in range(random.randint(4, 12)):
+            word = len(words)
+            tone = np.sin(2 * np.pi * (300 + 20 * (word % WORD_IDS)) * t) * 8000
+            gap = np.zeros(int(RATE * random.uniform(0.15, 0.3)))
+            parts += [tone, gap]
+            words.append(word % WORD_IDS)
+            length += len(tone) + len(gap)
+        pause = np.zeros(int(RATE * random.uniform(0.6, 1.5)))  # 文の切れ目
+        parts.append(pause)
+        length += len(pause)
+    samples = np.concatenate(parts)
+    samples = (samples + np.random.default_rng(0).normal(0, 30, len(samples))).astype(np.int16)
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(RATE)
+        wf.writeframes(samples.tobytes())
+    return buf.getvalue(), words
+
+
+def listen(samples, rate: int):
+    """無音で区切った音を単語として聞き取り、文ごとのセグメント（辞書）にする"""
+    frame = int(rate * 0.01)
+    n = len(samples) // frame
+    loud = np.abs(samples[:n * frame].astype(np.int32)).reshape(n, frame).max(axis=1) > 1000
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], loud.astype(np.int8), [0]])))
+    segments, current = [], None
+    for begin, end in zip(edges[::2], edges[1::2]):
+        tone = samples[begin * frame:end * frame]
+        frequency = np.argmax(np.abs(np.fft.rfft(tone))) * rate / len(tone)
+        word = round((frequency - 300) / 20)
+        start, stop = begin * frame / rate, end * frame / rate
+        if current is not None and start - current["end"] < 0.5:
+            current["text"] += f" w{word}"
+            current["end"] = stop
+        else:
+            current = {"start": start, "end": stop, "text": f" w{word}"}
+            segments.append(current)
+    return segments
+
+
+class FakeTranscriptions:
+    """音声の長さ÷speed 秒（＋0.2秒）待ってから聞き取った結果を返す"""
+
+    def __init__(self, speed: float):
+        self.speed = speed
+
+    def create(self, file, response_format, **options):
+        data = file[1] if isinstance(file, tuple) else file.read()
+        with wave.open(io.BytesIO(data)) as wf:
+            rate = wf.getframerate()
+            samples = np.frombuffer(wf.readframes(wf.getnframes()), "<i2")
+        time.sleep(0.2 + len(samples) / rate / self.speed)
+        segments = listen(samples, rate)
+        return SimpleNamespace(text="".join(s["text"] for s in segments), segments=segments)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--minutes", type=float, default=20)
+    parser.add_argument("--speed", type=float, default=300, help="APIが音声の何倍速で処理するか")
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    data, words = make_audio(args.minutes)
+    expected = " ".join(f"w{word}" for word in words)
+    client = SimpleNamespace(audio=SimpleNamespace(transcriptions=FakeTranscriptions(args.speed)))
+    print(f"音声: {args.minutes:.0f}分、{len(data) / 1e6:.1f}MB、単語{len(words)}個")
+
+    start = time.perf_counter()
+    text = client.audio.transcriptions.create(file=("all.wav", data), response_format="verbose_json").text.strip()
+    print(f"1回で送信       {time.perf_counter() - start:6.2f}s  一致: {text == expected}")
+
+    for workers in sorted({1, args.workers}):
+        start = time.perf_counter()
+        chunks = split_audio(data, "all.wav")
+        first = None
+        results = {}
+        for index, segments in transcribe_chunks(client, chunks, workers=workers):
+            first = first or time.perf_counter() - start
+            results[index] = segments
+        text = stitch(results, len(chunks))
+        print(f"{len(chunks)}チャンク・{workers}並行 {time.perf_counter() - start:6.2f}s"
+              f"（最初の表示 {first:.2f}s）  一致: {text == expected}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,39 +2,100 @@
 
 import io
 import wave
-import base64
-import sqlite3
 import streamlit as st
-from PIL import Image
-from groq import Groq
-from google import genai
 from google.genai import types
 from datetime import datetime
+from model_registry import ModelRegistry, RemoteModelList, add_sqlite_models, load_sqlite_models
+from tts_cache import AudioCache
+from chat_payload import build_messages, select_image_indexes, to_data_url
+from page_resources import get_connection, get_groq_client, get_genai_client, get_image_store
+from image_store import ImageCache, guess_mime_type
+from image_ingest import ingest_image
+from stream_render import StreamRenderer
+from image_view import show_image
+from reply_stream import fan_out
 
 PAGE_TITLE = "Free AI Chat"
 DATABASE_NAME = "/data/free_chat_history.db"
+HISTORY_PAGE_SIZE = 50  # 再実行ごとに描画する直近のメッセージ数
+MODEL_LIST_TTL = 3600  # Groqのモデル一覧を取り直す間隔（秒）
+TTS_MODEL = "gemini-2.5-flash-preview-tts"
+TTS_VOICE = "Leda"
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    used_at TEXT,
+    last_model_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    role TEXT,
+    content TEXT,
+    image BLOB,
+    image_hash TEXT,
+    model_id INTEGER,
+    FOREIGN KEY(chat_id) REFERENCES chats(id),
+    FOREIGN KEY(model_id) REFERENCES models(id)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id);
+CREATE TABLE IF NOT EXISTS reply_stats (
+    message_id INTEGER PRIMARY KEY,
+    ttft_ms INTEGER,
+    tokens INTEGER,
+    tokens_per_sec REAL,
+    FOREIGN KEY(message_id) REFERENCES messages(id)
+);
+"""
+COMPARE_MAX_MODELS = 4  # 比較モードで同時に送るモデル数の上限
+UNKNOWN_MODEL_NAME = "unknown"  # 削除されたモデルの応答に表示する名前
 
 def load_chats(c):
     c.execute("SELECT id, title, last_model_id FROM chats ORDER BY used_at DESC")
     return [list(row) for row in c.fetchall()]
 
-def load_messages(c, chat_id):
-    c.execute("SELECT id, role, content, image, model_id FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,))
-    return [{"id": row[0], "role": row[1], "content": row[2], "image": row[3], "model_id": row[4]} for row in c.fetchall()]
-
-def create_new_chat_id(c):
-    c.execute("SELECT seq FROM sqlite_sequence WHERE name='chats'")
-    result = c.fetchone()
-    if result is None:
-        return 1
-    else:
-        return int(result[0]) + 1
-
-def save_chat_and_message(c, conn, chat_id, user_message, image=None, model_id=None, chat_title="新しいチャット"):
+def load_messages(c, chat_id, after_id=0):
+    # 画像の本体は読まずにハッシュだけを返す（ファイルは get_image_store() から読む）
+    c.execute("""
+        SELECT m.id, m.role, m.content, m.image_hash, m.model_id, s.ttft_ms, s.tokens_per_sec
+        FROM messages m LEFT JOIN reply_stats s ON s.message_id = m.id
+        WHERE m.chat_id = ? AND m.id > ? ORDER BY m.id
+    """, (chat_id, after_id))
+    return [
+        {"id": row[0], "role": row[1], "content": row[2], "image_hash": row[3], "model_id": row[4], "ttft_ms": row[5], "tokens_per_sec": row[6]}
+        for row in c.fetchall()
+    ]
+
+def load_history(c, chat_id):
+    """表示中のチャット履歴をセッションに保持し、前回読み込んだ最後のメッセージより後だけをDBから読む"""
+    history = st.session_state.get("history")
+    if history is None or history["chat_id"] != chat_id:
+        history = {"chat_id": chat_id, "last_id": 0, "messages": [], "shown": HISTORY_PAGE_SIZE}
+        st.session_state.history = history
+    new_messages = load_messages(c, chat_id, history["last_id"])
+    if new_messages:
+        history["messages"].extend(new_messages)
+        history["last_id"] = new_messages[-1]["id"]
+    return history
+
+def truncate_history(message_id):
+    """delete_message() に合わせて、保持している履歴からmessage_id以降を取り除く"""
+    history = st.session_state.get("history")
+    if history is None:
+        return
+    history["messages"] = [msg for msg in history["messages"] if msg["id"] < message_id]
+    history["last_id"] = history["messages"][-1]["id"] if history["messages"] else 0
+
+def save_chat_and_message(c, conn, user_message, image_hash=None, model_id=None, chat_title="新しいチャット"):
+    """チャットを作成して最初のメッセージを保存し、採番されたチャットIDを返す"""
     now = datetime.now().isoformat()
-    c.execute("INSERT INTO chats (title, used_at, last_model_id) VALUES (?, ?, ?)", (chat_title, now, model_id))
-    c.execute("INSERT INTO messages (chat_id, role, content, image, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, "user", user_message, image, model_id))
+    # RETURNINGで、このINSERT自身が採番したIDを受け取る（別のINSERTのIDを拾うことがない）
+    c.execute("INSERT INTO chats (title, used_at, last_model_id) VALUES (?, ?, ?) RETURNING id", (chat_title, now, model_id))
+    chat_id = c.fetchone()[0]
+    c.execute("INSERT INTO messages (chat_id, role, content, image_hash, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, "user", user_message, image_hash, model_id))
     conn.commit()
+    return chat_id
 
 def update_chat_title(c, conn, chat_id, new_title):
     c.execute("UPDATE chats SET title = ? WHERE id = ?", (new_title, chat_id))
@@ -42,16 +103,31 @@ def update_chat_title(c, conn, chat_id, new_title):
 
 def delete_chat(c, conn, chat_id):
     c.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
+    c.execute("DELETE FROM reply_stats WHERE message_id IN (SELECT id FROM messages WHERE chat_id = ?)", (chat_id,))
     c.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
     conn.commit()
 
-def add_message(c, conn, chat_id, role, content, image=None, model_id=None):
+def add_message(c, conn, chat_id, role, content, image_hash=None, model_id=None):
+    """メッセージを保存し、採番されたIDを返す"""
     now = datetime.now().isoformat()
     c.execute("UPDATE chats SET used_at = ?, last_model_id = ? WHERE id = ?", (now, model_id, chat_id))
-    c.execute("INSERT INTO messages (chat_id, role, content, image, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, role, content, image, model_id))
+    c.execute("INSERT INTO messages (chat_id, role, content, image_hash, model_id) VALUES (?, ?, ?, ?, ?) RETURNING id", (chat_id, role, content, image_hash, model_id))
+    message_id = c.fetchone()[0]
+    conn.commit()
+    return message_id
+
+def save_reply_stats(c, conn, message_id, stats):
+    """応答の最初のトークンまでの時間と出力速度を保存する"""
+    if stats.ttft is None:
+        return
+    c.execute(
+        "INSERT INTO reply_stats (message_id, ttft_ms, tokens, tokens_per_sec) VALUES (?, ?, ?, ?)",
+        (message_id, round(stats.ttft * 1000), stats.tokens, stats.tokens_per_sec),
+    )
     conn.commit()
 
 def delete_message(c, conn, message_id, now_chat_id):
+    c.execute("DELETE FROM reply_stats WHERE message_id IN (SELECT id FROM messages WHERE chat_id = ? AND id >= ?)", (now_chat_id, message_id))
     c.execute("DELETE FROM messages WHERE chat_id = ? AND id >= ?", (now_chat_id, message_id))
     conn.commit()
 
@@ -74,22 +150,200 @@ def wave_file_bytes(pcm, channels=1, rate=24000, sample_width=2):
 
 def generate_audio(gen_client, text):
     content = f'Japanese Female: {text}'
+    # 同じ内容の音声はキャッシュから返す（text_to_speech.pyで同じ設定で生成したものも使える）
+    audio_cache = get_audio_cache()
+    key = audio_cache.key(TTS_MODEL, TTS_VOICE, content)
+    audio_bytes = audio_cache.get(key)
+    if audio_bytes is not None:
+        return audio_bytes
     response = gen_client.models.generate_content(
-        model="gemini-2.5-flash-preview-tts",
+        model=TTS_MODEL,
         contents=content,
         config=types.GenerateContentConfig(
             response_modalities=["AUDIO"],
             speech_config=types.SpeechConfig(
                 voice_config=types.VoiceConfig(
                     prebuilt_voice_config=types.PrebuiltVoiceConfig(
-                        voice_name="Leda",
+                        voice_name=TTS_VOICE,
                     )
                 )
             ),
         )
     )
     blob = response.candidates[0].content.parts[0].inline_data.data
-    return wave_file_bytes(blob)
+    audio_bytes = wave_file_bytes(blob)
+    audio_cache.put(key, audio_bytes)
+    return audio_bytes
+
+def build_gemini_history(messages, image_indexes):
+    """Gemini用の会話履歴を組み立てる（送信時にだけ呼ぶ。画像はimage_indexesの番号のメッセージだけ添付する）"""
+    chat_history = []
+    for i, msg in enumerate(messages):
+        if msg["role"] == "assistant":
+            chat_history.append(types.Content(role="model", parts=[types.Part.from_text(text=msg["content"])]))
+        elif msg["role"] == "user":
+            chat_history.append(types.UserContent(parts=[types.Part.from_text(text=msg["content"])]))
+            if i not in image_indexes:
+                continue
+            try:
+                image_bytes = get_image_cache().get(msg["image_hash"])
+            except FileNotFoundError:  # 整理で削除された画像は送らない
+                continue
+            chat_history.append(types.UserContent(parts=[types.Part.from_bytes(data=image_bytes, mime_type=guess_mime_type(image_bytes))]))
+    return chat_history
+
+def select_replies(messages, model_id):
+    """比較モードで応答が複数並ぶ箇所は、model_idの応答（なければ最初のモデルの応答）だけを履歴に残す"""
+    selected = []
+    replies = []
+    for msg in messages + [None]:
+        if msg is not None and msg["role"] != "user":
+            replies.append(msg)
+            continue
+        reply_model_ids = [reply["model_id"] for reply in replies if reply["role"] == "assistant"]
+        keep_id = model_id if model_id in reply_model_ids else reply_model_ids[0] if reply_model_ids else None
+        selected.extend(reply for reply in replies if reply["model_id"] == keep_id)
+        replies = []
+        if msg is not None:
+            selected.append(msg)
+    return selected
+
+def group_messages(messages):
+    """表示用に、ユーザー発言は1件ずつ、続く応答はモデルごとのリストにまとめて順に返す"""
+    replies = {}
+    for msg in messages + [None]:
+        if msg is not None and msg["role"] != "user":
+            replies.setdefault(msg["model_id"], []).append(msg)
+            continue
+        if replies:
+            yield "replies", list(replies.values())
+            replies = {}
+        if msg is not None:
+            yield "user", msg
+
+def open_reply(groq_client, gen_client, model_name, messages, image_bytes, use_image):
+    """(role, 差分) を順に返すストリーム関数を返す
+
+    履歴の変換（画像の読み込みやキャッシュ）はここで済ませ、返した関数は別スレッドでAPIを呼ぶだけにする。
+    """
+    if model_name.startswith("gem"):
+        # 添付する画像は、今回の画像を含めて新しい方から CONTEXT_IMAGE_LIMIT 件にする（build_messagesと同じ）
+        image_indexes = select_image_indexes(messages, use_image)
+        chat_history = build_gemini_history(messages[:-1], image_indexes)
+        if image_bytes and len(messages) - 1 in image_indexes:
+            chat_history.append(types.UserContent(parts=[types.Part.from_bytes(data=image_bytes, mime_type=guess_mime_type(image_bytes))]))
+
+        def stream():
+            chat = gen_client.chats.create(
+                model=model_name,
+                history=chat_history,
+            )
+            for chunk in chat.send_message_stream(messages[-1]["content"]):
+                yield "assistant", chunk.text
+                if chunk.usage_metadata and chunk.usage_metadata.candidates_token_count:
+                    yield "usage", chunk.usage_metadata.candidates_token_count
+    else:
+        processed_messages = build_messages(messages, message_data_url, use_image)
+
+        def stream():
+            response = groq_client.chat.completions.create(
+                model=model_name,
+                messages=processed_messages,
+                stream=True,
+            )
+            for chunk in response:
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq and x_groq.usage:  # 最後のチャンクに出力トークン数が付く
+                    yield "usage", x_groq.usage.completion_tokens
+                if chunk.choices and chunk.choices[0].finish_reason != 'stop':
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        yield "assistant", delta.content
+                    elif delta.reasoning:
+                        yield "reasoning", delta.reasoning
+    return stream
+
+@st.fragment
+def show_message(gen_client, msg, model_name, use_image):
+    # 音声再生ボタンなどの操作ではこのメッセージだけを再実行し、履歴全体は描画し直さない
+    if msg["role"] == "assistant":
+        with st.chat_message(avatar_name(model_name)):
+            st.markdown(msg["content"])
+            st.badge(model_name)
+            if msg.get("ttft_ms") is not None:
+                speed = f" · {msg['tokens_per_sec']:.0f} tokens/s" if msg["tokens_per_sec"] else ""
+                st.caption(f"最初の応答まで {msg['ttft_ms'] / 1000:.2f}秒{speed}")
+            if st.button("音声として再生", icon=":material/play_circle:", key=f"audio_{msg['id']}"):
+                with st.spinner("音声に変換中..."):
+                    audio_bytes = generate_audio(gen_client, msg["content"])
+                st.audio(audio_bytes, format="audio/wav", autoplay=True)
+    elif msg["role"] == "reasoning":
+        with st.chat_message(avatar_name(model_name)):
+            with st.expander("Reasoning"):
+                st.caption(msg["content"])
+    else:
+        with st.chat_message("user"):
+            col1, col2 = st.columns([0.99, 0.01], vertical_alignment="center")
+            with col1:
+                st.text(msg["content"])
+                if msg["image_hash"]: # 画像がある場合はサムネイルを表示
+                    if use_image:
+                        show_image(msg["image_hash"], f"free_{msg['id']}")
+                    else:
+                        st.error("選択中のモデルは画像に対応していません。")
+            with col2:
+                if st.button(":material/delete:", key=f"user_{msg['id']}"):
+                    st.session_state.now_message_id = msg["id"]
+                    st.rerun()
+
+@st.cache_resource(max_entries=64)
+def image_data_url(image_hash):
+    # 画像はハッシュで一意に決まるため、同じ画像は一度だけ読み込んでエンコードする
+    image = get_image_store().get(image_hash)
+    return to_data_url(image, guess_mime_type(image))
+
+def message_data_url(msg):
+    try:
+        return image_data_url(msg["image_hash"])
+    except FileNotFoundError:  # 整理で削除された画像は送らない
+        return None
+
+@st.cache_resource
+def get_image_cache():
+    return ImageCache(get_image_store())
+
+@st.cache_resource
+def get_audio_cache():
+    return AudioCache()
+
+@st.cache_resource
+def get_model_registry():
+    # モデル一覧はプロセスごとに一度だけ読み込む（更新時は get_model_registry().reload()）
+    return ModelRegistry(lambda: load_sqlite_models(DATABASE_NAME)).reload()
+
+@st.cache_resource
+def get_remote_models():
+    # 新しいモデルはmodelsテーブルに追加し、選択肢に出るようレジストリを読み直す
+    groq_client = get_groq_client()
+    registry = get_model_registry()
+
+    def on_update(names):
+        if add_sqlite_models(DATABASE_NAME, names):
+            registry.reload()
+
+    remote_models = RemoteModelList(lambda: [m.id for m in groq_client.models.list().data], MODEL_LIST_TTL, on_update)
+    remote_models.refresh_async()
+    return remote_models
+
+def history_model_name(registry, model_id):
+    # モデルが削除された応答も、履歴には仮の名前で表示する
+    model = registry.get(model_id)
+    return model.name if model else UNKNOWN_MODEL_NAME
+
+def avatar_name(model_name):
+    # "meta-llama/llama-4-scout" → "llama/llama" のように、2番目の区切りをアバター名にする
+    parts = model_name.split('-')
+    return parts[1] if len(parts) > 1 else model_name
 
 def main():
     st.set_page_config(
@@ -99,34 +353,12 @@ def main():
         layout="wide",
     )
     st.title(PAGE_TITLE)
-    groq_client = Groq()
-    gen_client = genai.Client()
+    groq_client = get_groq_client()
+    gen_client = get_genai_client()
 
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection(DATABASE_NAME, SCHEMA)
     c = conn.cursor()
 
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS chats (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        title TEXT,
-        used_at TEXT,
-        last_model_id INTEGER
-    )
-    """)
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        chat_id INTEGER,
-        role TEXT,
-        content TEXT,
-        image BLOB,
-        model_id INTEGER,
-        FOREIGN KEY(chat_id) REFERENCES chats(id),
-        FOREIGN KEY(model_id) REFERENCES models(id)
-    )
-    """)
-    conn.commit()
-
     session_var_list = ["now_chat_id", "edit_chat_id", "is_new_chat"]
     for session_var in session_var_list:
         if session_var not in st.session_state:
@@ -135,23 +367,29 @@ def main():
     if "free_model_id" not in st.session_state:
         st.session_state.free_model_id = 1
 
-    c.execute("SELECT name, display FROM models ORDER BY id")
-    model_rows = c.fetchall()
-    model_names = [row[0] for row in model_rows]
-    model_displays = [row[1] for row in model_rows]
-
-    c.execute("SELECT id FROM models WHERE image = 1")
-    image_model_ids = [row[0] for row in c.fetchall()]
+    registry = get_model_registry()
+    # 期限切れならバックグラウンドで取り直し、新しいモデルは次の再実行から選択肢に出る
+    remote_models = get_remote_models().get()
+    model_ids = [m.id for m in registry.all()]
+    image_model_ids = registry.image_model_ids
 
     with st.sidebar:
         if st.button(":heavy_plus_sign: 新しいチャット"):
-            st.session_state.now_chat_id = create_new_chat_id(c)
+            # チャットIDは最初のメッセージを保存したときに採番する
+            st.session_state.now_chat_id = None
             st.session_state.is_new_chat = True
             st.rerun()
 
         st.header(":material/psychology: モデル選択")
-        selected_display = st.selectbox("モデル選択", model_displays, index=st.session_state.free_model_id-1, label_visibility="collapsed")
-        st.session_state.free_model_id = model_displays.index(selected_display) + 1
+        current_index = model_ids.index(st.session_state.free_model_id) if st.session_state.free_model_id in model_ids else 0
+        st.session_state.free_model_id = st.selectbox("モデル選択", model_ids, index=current_index, format_func=lambda model_id: registry.get(model_id).display, label_visibility="collapsed")
+        if st.toggle("比較モード", key="compare_mode", help="同じ質問を複数のモデルに同時に送り、回答を並べて表示します"):
+            # 一覧から消えたモデルは選択から外す
+            st.session_state.compare_model_ids = [i for i in st.session_state.get("compare_model_ids", []) if i in model_ids]
+            st.multiselect(
+                "比較するモデル", model_ids, key="compare_model_ids", max_selections=COMPARE_MAX_MODELS,
+                format_func=lambda model_id: registry.get(model_id).display, placeholder="比較するモデルを選択",
+            )
 
         st.header(":material/chat: チャット一覧")
         for chat_id, title, last_model_id in load_chats(c):
@@ -182,69 +420,54 @@ def main():
                         st.session_state.now_chat_id = None
                     st.rerun()
 
-    if "now_message_id" in st.session_state:
+    if st.session_state.get("now_message_id") is not None:
         delete_message(c, conn, st.session_state.now_message_id, st.session_state.now_chat_id)
+        truncate_history(st.session_state.now_message_id)
     st.session_state.now_message_id = None
 
     chat_id = st.session_state.now_chat_id
-    if chat_id:
+    if chat_id or st.session_state.is_new_chat:
         if st.session_state.is_new_chat:
             messages = []
+            shown_messages = []
         else:
-            messages = load_messages(c, chat_id)
-
-        chat_history = []
-        for i, msg in enumerate(messages):
-            if msg["role"] == "assistant":
-                chat_history.append(types.Content(role="model", parts=[types.Part.from_text(text=msg["content"])]))
-                model_name = model_names[msg["model_id"]-1]
-                with st.chat_message(model_name.split('-')[1]):
-                    st.markdown(msg["content"])
-                    st.badge(model_name)
-                    if st.button("音声として再生", icon=":material/play_circle:", key=i):
-                        with st.spinner("音声に変換中..."):
-                            audio_bytes = generate_audio(gen_client, msg["content"])
-                        st.audio(audio_bytes, format="audio/wav", autoplay=True)
-
-            elif msg["role"] == "reasoning":
-                model_name = model_names[messages[i+1]["model_id"]-1]
-                with st.chat_message(model_name.split('-')[1]):
-                    with st.expander("Reasoning"):
-                        st.caption(msg["content"])
-            else:
-                chat_history.append(types.UserContent(parts=[types.Part.from_text(text=msg["content"])]))
-                with st.chat_message("user"):
-                    col1, col2 = st.columns([0.99, 0.01], vertical_alignment="center")
-                    with col1:
-                        st.text(msg["content"])
-                        if msg["image"]: # 画像がある場合は表示
-                            if st.session_state.free_model_id in image_model_ids:
-                                image = Image.open(io.BytesIO(msg["image"]))
-                                chat_history.append(types.UserContent(parts=[types.Part.from_bytes(data=msg["image"], mime_type="image/jpeg")]))
-                                st.image(image)
-                            else:
-                                st.error("選択中のモデルは画像に対応していません。")
-                    with col2:
-                        if st.button(":material/delete:", key=f"user_{msg['id']}"):
-                            st.session_state.now_message_id = msg["id"]
-                            st.rerun()
-            msg.pop("model_id", None)
-            msg.pop("id", None)
+            history = load_history(c, chat_id)
+            messages = history["messages"]
+            # 古いメッセージは必要になるまで描画せず、再実行のコストを履歴の長さによらず一定にする
+            shown_messages = messages[-history["shown"]:]
+            if len(messages) > len(shown_messages):
+                if st.button("以前のメッセージを表示", icon=":material/expand_less:"):
+                    history["shown"] += HISTORY_PAGE_SIZE
+                    st.rerun()
+
+        use_image = st.session_state.free_model_id in image_model_ids
+        for kind, item in group_messages(shown_messages):
+            if kind == "user":
+                show_message(gen_client, item, None, use_image)  # ユーザー発言はモデル名を使わない
+                continue
+            # 比較モードの応答はモデルごとに列を分けて並べる
+            columns = st.columns(len(item)) if len(item) > 1 else [st.container()]
+            for column, replies in zip(columns, item):
+                with column:
+                    for msg in replies:
+                        show_message(gen_client, msg, history_model_name(registry, msg["model_id"]), use_image)
+
+        if st.session_state.get("compare_mode") and st.session_state.get("compare_model_ids"):
+            target_model_ids = st.session_state.compare_model_ids
+        else:
+            target_model_ids = [st.session_state.free_model_id]
 
         if prompt := st.chat_input("質問してみましょう", accept_file=True):
             image_bytes = None
+            image_hash = None
             if prompt["files"]:
-                if st.session_state.free_model_id in image_model_ids:
-                    image_file = prompt["files"][0]
-                    image = Image.open(image_file)
-                    if image.width > 1920 or image.height > 1920:
-                        image.thumbnail((1920, 1920))
-                    image_bytes = io.BytesIO()
-                    if image.mode == "RGBA":
-                        image = image.convert("RGB")
-                    image.save(image_bytes, format="JPEG")
-                    image_bytes = image_bytes.getvalue()
-                    chat_history.append(types.UserContent(parts=[types.Part.from_bytes(data=image_bytes, mime_type="image/jpeg")]))
+                if any(model_id in image_model_ids for model_id in target_model_ids):
+                    try:
+                        image_bytes, _ = ingest_image(prompt["files"][0].getvalue())
+                    except ValueError as e:
+                        st.error(str(e))
+                        st.stop()
+                    image_hash = get_image_store().put(image_bytes)
                 else:
                     st.error("選択中のモデルは画像に対応していません。")
             ask_text = prompt.text
@@ -253,93 +476,80 @@ def main():
                     chat_title = generate_title(gen_client, ask_text)
                 else:
                     chat_title = ask_text
-                save_chat_and_message(c, conn, chat_id, ask_text, image_bytes, st.session_state.free_model_id, chat_title)
+                chat_id = save_chat_and_message(c, conn, ask_text, image_hash, st.session_state.free_model_id, chat_title)
+                st.session_state.now_chat_id = chat_id
                 st.session_state.is_new_chat = False
             else:
-                add_message(c, conn, chat_id, "user", ask_text, image_bytes, st.session_state.free_model_id)
-            messages.append({
+                add_message(c, conn, chat_id, "user", ask_text, image_hash, st.session_state.free_model_id)
+            # 保持している履歴は次の再実行でDBから追記されるため、送信用には別のリストを作る
+            messages = messages + [{
                 "role": "user",
                 "content": ask_text,
-                "image": image_bytes
-            })
+                "image_hash": image_hash
+            }]
 
             # ユーザーメッセージ表示
             with st.chat_message("user"):
                 col1, col2 = st.columns([0.99, 0.01], vertical_alignment="center")
                 with col1:
                     st.text(ask_text)
-                    if image_bytes:
-                        st.image(image_bytes)
+                    if image_hash:
+                        st.image(get_image_store().thumbnail_path(image_hash))
                 with col2:
                     if st.button(":material/delete:", key=f"user_{len(messages)}"):
                         st.session_state.now_message_id = len(messages)
                         st.rerun()
 
-            # アシスタント応答生成
-            model_name = model_names[st.session_state.free_model_id-1]
-            with st.chat_message(model_name.split('-')[1]):
-                reasoning_placeholder = st.empty()
-                message_placeholder = st.empty()
-            if model_name.startswith("gem"):
-                chat = gen_client.chats.create(
-                    model=model_name,
-                    history=chat_history,
-                )
-                response = chat.send_message_stream(ask_text)
-            else:
-                processed_messages = []
-                for m in messages:
-                    if m["image"] and st.session_state.free_model_id in image_model_ids: # 画像付きメッセージの場合
-                        processed_messages.append({
-                            "role": m["role"],
-                            "content": [
-                                {"type": "text", "text": m["content"]},
-                                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(m['image']).decode('utf-8')}"}}
-                            ]
-                        })
-                    elif m["role"] != "reasoning": # テキストのみのメッセージの場合
-                        processed_messages.append({
-                            "role": m["role"],
-                            "content": [
-                                {"type": "text", "text": m["content"]}
-                            ]
+            # アシスタント応答生成（比較モードでは全モデルに同時に送り、届いた順に各列へ描画する）
+            columns = st.columns(len(target_model_ids)) if len(target_model_ids) > 1 else [st.container()]
+            streams = []
+            renderers = []
+            for column, model_id in zip(columns, target_model_ids):
+                model_name = registry.get(model_id).name
+                with column:
+                    with st.chat_message(avatar_name(model_name)):
+                        renderers.append({
+                            "reasoning": StreamRenderer(st.container(), method="caption"),
+                            "assistant": StreamRenderer(st.container()),
+                            "status": st.empty(),
                         })
-                response = groq_client.chat.completions.create(
-                    model=model_name,
-                    messages=processed_messages,
-                    stream=True,
-                )
-            resoning_text = ""
-            response_text = ""
-            for chunk in response:
-                if model_name.startswith("gem"):
-                    if hasattr(chunk, "text"):
-                        try:
-                            response_text += chunk.text
-                            message_placeholder.markdown(response_text)
-                        except Exception as e:
-                            st.warning(e)
+                streams.append(open_reply(
+                    groq_client, gen_client, model_name, select_replies(messages, model_id),
+                    image_bytes, model_id in image_model_ids,
+                ))
+            results = {}
+            for index, kind, value in fan_out(streams):
+                if kind in ("done", "error"):
+                    results[index] = (kind, value)
+                    renderers[index]["reasoning"].flush()
+                    renderers[index]["assistant"].flush()
+                    if kind == "error":
+                        renderers[index]["status"].error(value)
                 else:
-                    if chunk.choices[0].finish_reason != 'stop':
-                        content = chunk.choices[0].delta.content
-                        reasoning = chunk.choices[0].delta.reasoning
-                        if content:
-                            response_text += content
-                            message_placeholder.markdown(response_text)
-                        elif reasoning:
-                            resoning_text += chunk.choices[0].delta.reasoning
-                            reasoning_placeholder.caption(resoning_text)
-                    
-            if resoning_text:
-                add_message(c, conn, chat_id, "reasoning", resoning_text, None, st.session_state.free_model_id)
-            add_message(c, conn, chat_id, "assistant", response_text, None, st.session_state.free_model_id)
-
-            st.rerun()
+                    renderers[index][kind].write(value)
+
+            for index, model_id in enumerate(target_model_ids):
+                kind, value = results[index]
+                reasoning_text = renderers[index]["reasoning"].text
+                response_text = renderers[index]["assistant"].text
+                if kind == "error" and not response_text:
+                    continue
+                if reasoning_text:
+                    add_message(c, conn, chat_id, "reasoning", reasoning_text, None, model_id)
+                message_id = add_message(c, conn, chat_id, "assistant", response_text, None, model_id)
+                if kind == "done":
+                    save_reply_stats(c, conn, message_id, value)
+
+            # エラーが表示されている場合は再実行せずに残す
+            if all(kind == "done" for kind, _ in results.values()):
+                st.rerun()
     else:
         st.info("左のサイドバーからチャットを作成または選択してください。")
         st.warning("Geminiの入力は学習に使用されます。")
-        all_model = sorted([m.id for m in groq_client.models.list().data])
-        st.html("<br>".join(all_model))
+        if remote_models:
+            st.html("<br>".join(remote_models))
+        else:
+            st.caption("モデル一覧を取得中です。")
 
 if __name__ == "__main__" or True:  # Streamlitでは直接実行されるため
     main()
\ No newline at end of file
@@ -1,44 +1,54 @@
-import sqlite3
 import streamlit as st
-from google import genai
-from google.genai import types
-from PIL import Image
-from io import BytesIO
 from datetime import datetime
+from page_resources import get_connection, get_genai_client, get_image_store
+from image_jobs import ImageJobRunner
+from image_view import show_image
+from image_ingest import ingest_image
 
 PAGE_TITLE = "Gemini 画像生成"
 MODEL = "gemini-2.0-flash-preview-image-generation"
-
-st.set_page_config(
-    page_title=PAGE_TITLE,
-    page_icon=":material/image:",
-    initial_sidebar_state="expanded",
-    layout="wide",
-)
-st.title(PAGE_TITLE)
-
-client = genai.Client()
-
-conn = sqlite3.connect("/data/with_image.db", check_same_thread=False)
-c = conn.cursor()
-c.execute("""
+DATABASE_NAME = "/data/with_image.db"
+JOB_POLL_INTERVAL = 2  # 生成中のジョブを確認する間隔（秒）
+MAX_VARIATIONS = 4  # 1つのプロンプトで同時に生成する枚数の上限
+SCHEMA = """
 CREATE TABLE IF NOT EXISTS chats (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     title TEXT,
     used_at TEXT
-)
-""")
-c.execute("""
+);
 CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     chat_id INTEGER,
     role TEXT,
     content TEXT,
     image BLOB,
+    image_hash TEXT,
+    reply_to INTEGER,
     FOREIGN KEY(chat_id) REFERENCES chats(id)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id);
+"""
+
+st.set_page_config(
+    page_title=PAGE_TITLE,
+    page_icon=":material/image:",
+    initial_sidebar_state="expanded",
+    layout="wide",
 )
-""")
-conn.commit()
+st.title(PAGE_TITLE)
+
+client = get_genai_client()
+
+conn = get_connection(DATABASE_NAME, SCHEMA)
+image_store = get_image_store()
+
+@st.cache_resource
+def get_job_runner():
+    # ワーカーはプロセスで共有し、どのセッションから登録したジョブも同じプールで生成する
+    return ImageJobRunner(DATABASE_NAME, client, MODEL, image_store)
+
+job_runner = get_job_runner()
+c = conn.cursor()
 
 session_var_list = ["chat_id", "edit_id", "is_new"]
 for session_var in session_var_list:
@@ -50,40 +60,42 @@ def load_chats():
     return [list(row) for row in c.fetchall()]
 
 def load_messages(chat_id):
-    c.execute("SELECT id, role, content, image FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,))
-    return [{"id": row[0], "role": row[1], "content": row[2], "image": row[3]} for row in c.fetchall()]
-
-def create_new_chat_id():
-    c.execute("SELECT seq FROM sqlite_sequence WHERE name='chats'")
-    result = c.fetchone()
-    if result is None:
-        return 1
-    else:
-        return int(result[0]) + 1
-
-def save_chat_and_message(chat_id, user_message, image=None, chat_title="新しいチャット"):
+    # 生成結果は、後から送ったプロンプトよりIDが大きくても、もとのプロンプトの直後に並べる
+    c.execute("SELECT id, role, content, image_hash FROM messages WHERE chat_id = ? ORDER BY COALESCE(reply_to, id), id", (chat_id,))
+    return [{"id": row[0], "role": row[1], "content": row[2], "image_hash": row[3]} for row in c.fetchall()]
+
+def save_chat_and_message(user_message, image_hash=None, chat_title="新しいチャット"):
+    """チャットを作成して最初のメッセージを保存し、採番されたチャットIDとメッセージIDを返す"""
     now = datetime.now().isoformat()
-    c.execute("INSERT INTO chats (title, used_at) VALUES (?, ?)", (chat_title, now))
-    c.execute("INSERT INTO messages (chat_id, role, content, image) VALUES (?, ?, ?, ?)", (chat_id, "user", user_message, image))
+    # RETURNINGで、このINSERT自身が採番したIDを受け取る（別のINSERTのIDを拾うことがない）
+    c.execute("INSERT INTO chats (title, used_at) VALUES (?, ?) RETURNING id", (chat_title, now))
+    chat_id = c.fetchone()[0]
+    c.execute("INSERT INTO messages (chat_id, role, content, image_hash) VALUES (?, ?, ?, ?) RETURNING id", (chat_id, "user", user_message, image_hash))
+    message_id = c.fetchone()[0]
     conn.commit()
+    return chat_id, message_id
 
 def update_chat_title(chat_id, new_title):
     c.execute("UPDATE chats SET title = ? WHERE id = ?", (new_title, chat_id))
     conn.commit()
 
 def delete_chat(chat_id):
+    c.execute("DELETE FROM image_jobs WHERE chat_id = ?", (chat_id,))
     c.execute("DELETE FROM chats WHERE id = ?", (chat_id,))
     c.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
     conn.commit()
 
-def add_message(chat_id, role, content, image=None):
+def add_message(chat_id, role, content, image_hash=None):
+    """メッセージを保存し、採番されたIDを返す"""
     now = datetime.now().isoformat()
     c.execute("UPDATE chats SET used_at = ? WHERE id = ?", (now, chat_id))
-    c.execute("INSERT INTO messages (chat_id, role, content, image) VALUES (?, ?, ?, ?)", (chat_id, role, content, image))
+    c.execute("INSERT INTO messages (chat_id, role, content, image_hash) VALUES (?, ?, ?, ?) RETURNING id", (chat_id, role, content, image_hash))
+    message_id = c.fetchone()[0]
     conn.commit()
+    return message_id
 
 def delete_message(message_id, now_chat_id):
-    c.execute("DELETE FROM messages WHERE chat_id = ? AND id >= ?", (now_chat_id, message_id))
+    c.execute("DELETE FROM messages WHERE chat_id = ? AND COALESCE(reply_to, id) >= ?", (now_chat_id, message_id))
     conn.commit()
 
 def generate_title(prompt):
@@ -93,9 +105,33 @@ def generate_title(prompt):
     )
     return response.text
 
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_jobs(chat_id):
+    """生成中・失敗したジョブを表示し、終わったジョブがあればページ全体を再実行して結果を読み込む"""
+    jobs = job_runner.jobs(chat_id)
+    pending = {job["id"] for job in jobs if job["status"] != "error"}
+    pending_jobs = st.session_state.setdefault("pending_jobs", {})
+    finished = pending_jobs.get(chat_id, set()) - pending
+    pending_jobs[chat_id] = pending
+    if finished:
+        st.rerun(scope="app")
+    for job in jobs:
+        with st.chat_message("assistant", avatar=":material/wand_stars:"):
+            if job["status"] == "error":
+                col1, col2 = st.columns([0.9, 0.1], vertical_alignment="center")
+                col1.error(job["error"])
+                if col2.button(":material/close:", key=f"job_{job['id']}", type="tertiary"):
+                    job_runner.dismiss(job["id"])
+                    st.rerun(scope="fragment")
+            elif job["status"] == "running":
+                st.caption(":material/progress_activity: 生成中...")
+            else:
+                st.caption(":material/schedule: 順番待ち")
+
 with st.sidebar:
     if st.button(":heavy_plus_sign: 新しいチャット"):
-        st.session_state.chat_id = create_new_chat_id()
+        # チャットIDは最初のメッセージを保存したときに採番する
+        st.session_state.chat_id = None
         st.session_state.is_new = True
         st.rerun()
 
@@ -132,83 +168,57 @@ if "del_message_id" in st.session_state:
 st.session_state.del_message_id = None
 
 chat_id = st.session_state.chat_id
-if chat_id:
-    contents = []
+if chat_id or st.session_state.is_new:
     if not st.session_state.is_new:
         messages = load_messages(chat_id)
         for i, msg in enumerate(messages):
             if msg["role"] == "assistant":
                 with st.chat_message("assistant", avatar=":material/wand_stars:"):
-                    st.markdown(msg["content"])
-                    if msg["image"]:
-                        image = Image.open(BytesIO(msg["image"]))
-                        st.image(image)
+                    if msg["content"] is not None:
+                        st.markdown(msg["content"])
+                    if msg["image_hash"]: # 元の解像度の画像はボタンを押したときだけ送る
+                        show_image(msg["image_hash"], f"gemini_{msg['id']}")
             else:
                 with st.chat_message("user"):
                     col1, col2 = st.columns([0.99, 0.01], vertical_alignment="center")
-                    if msg["image"]:
-                        image = Image.open(BytesIO(msg["image"]))
-                        col1.image(image)
-                        contents.append(image)
+                    if msg["image_hash"]:
+                        with col1:
+                            show_image(msg["image_hash"], f"gemini_{msg['id']}")
                     col1.text(msg["content"])
-                    contents.append(msg["content"])
                     if col2.button(":material/delete:", key=f"user_{msg['id']}"):
                         st.session_state.del_message_id = msg["id"]
                         st.rerun()
-        
+        if job_runner.jobs(chat_id):
+            show_jobs(chat_id)
+
+    variations = st.segmented_control(
+        "生成する枚数", options=list(range(1, MAX_VARIATIONS + 1)), default=1,
+        format_func=lambda n: f"{n}枚", key="variations",
+    ) or 1
     if prompt := st.chat_input("画像生成したいプロンプトを入力...", accept_file=True):
         ask_text = prompt.text
-        image_bytes = None
-            
-        with st.chat_message("user"):
-            st.text(ask_text)
-
-            if prompt["files"]:
-                image = prompt["files"][0]
-                image_bytes = image.read()
-                st.image(image)
-                contents.append(types.Part.from_bytes(
-                    data=image_bytes,
-                    mime_type='image/jpeg',
-                ))
-        contents.append(ask_text)
-        config=types.GenerateContentConfig(
-            response_modalities=['TEXT', 'IMAGE']
-        )
+        image_hash = None
+        if prompt["files"]:
+            try:
+                image_bytes, _ = ingest_image(prompt["files"][0].getvalue())
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
+            image_hash = image_store.put(image_bytes)
+
         if st.session_state.is_new:
             if len(ask_text) > 20:
                 chat_title = generate_title(ask_text)
             else:
                 chat_title = ask_text
-            save_chat_and_message(chat_id, ask_text, image_bytes, chat_title)
+            chat_id, message_id = save_chat_and_message(ask_text, image_hash, chat_title)
+            st.session_state.chat_id = chat_id
             st.session_state.is_new = False
         else:
-            add_message(chat_id, "user", ask_text, image_bytes)
-
-        with st.spinner("Wait for it...", show_time=True):
-            response = client.models.generate_content(
-                model=MODEL,
-                contents=contents,
-                config=config
-            )
-            answer = None
-            image = None
-            for part in response.candidates[0].content.parts:
-                if part.text is not None:
-                    answer = part.text
-                elif part.inline_data is not None:
-                    image_bytes = part.inline_data.data
-                    image = Image.open(BytesIO((image_bytes)))
-
-        if image:
-            with st.chat_message("assistant", avatar=':material/wand_stars:'):
-                if answer is not None:
-                    st.write(answer)
-                st.image(image)
-
-            add_message(chat_id, "assistant", answer, image_bytes)
-            st.rerun()
-        else:
-            st.error(f"画像が生成されませんでした。{response}")
+            message_id = add_message(chat_id, "user", ask_text, image_hash)
+
+        # 生成はバックグラウンドで行い、結果は show_jobs() が見つけて表示する
+        job_runner.submit(chat_id, message_id, variations)
+        st.rerun()
 else:
     st.info("左のサイドバーからチャットを作成または選択してください。")
\ No newline at end of file
@@ -1,10 +1,12 @@
-import io
-import base64
-import sqlite3
 import streamlit as st
-from openai import OpenAI
+from ulid import ULID
 from datetime import datetime
-from PIL import Image
+from model_registry import ModelInfo, ModelRegistry
+from chat_payload import build_messages, to_data_url
+from page_resources import get_connection, get_openai_client, get_image_store
+from image_store import guess_mime_type
+from image_ingest import ingest_image
+from image_view import show_image
 
 PAGE_TITLE = "OpenAI"
 DATABASE_NAME = "/data/chat_history.db"
@@ -16,42 +18,60 @@ MODEL_OPTIONS = {
     "GPT-4o-search": "gpt-4o-search-preview",
     "GPT-5-chat": "gpt-5-chat-latest",
 }
-model_name_list = list(MODEL_OPTIONS.values())
-
-st.set_page_config(
-    page_title=PAGE_TITLE,
-    page_icon=":material/network_intelligence:",
-    initial_sidebar_state="expanded",
-    layout="wide",
-)
-st.title(PAGE_TITLE)
-
-client = OpenAI()
-
-conn = sqlite3.connect(DATABASE_NAME)
-c = conn.cursor()
-
-c.execute("""
+SCHEMA = """
 CREATE TABLE IF NOT EXISTS chats (
     id TEXT PRIMARY KEY,
     title TEXT,
     created_at TEXT,
     last_model_id INTEGER,
     deleted INTEGER DEFAULT 0
-)
-""")
-c.execute("""
+);
 CREATE TABLE IF NOT EXISTS messages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     chat_id INTEGER,
     role TEXT,
     content TEXT,
     image BLOB,
+    image_hash TEXT,
     model_id INTEGER,
     FOREIGN KEY(chat_id) REFERENCES chats(id)
+);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id);
+"""
+
+@st.cache_resource
+def get_model_registry():
+    # モデルIDは MODEL_OPTIONS の並び順（1始まり）で保存している
+    return ModelRegistry.from_rows([
+        ModelInfo(id=i + 1, name=name, display=label, image="-search" not in name, reasoning=False, context_tokens=None)
+        for i, (label, name) in enumerate(MODEL_OPTIONS.items())
+    ])
+
+@st.cache_resource(max_entries=64)
+def image_data_url(image_hash):
+    # 画像はハッシュで一意に決まるため、同じ画像は一度だけ読み込んでエンコードする
+    image = get_image_store().get(image_hash)
+    return to_data_url(image, guess_mime_type(image))
+
+def message_data_url(msg):
+    try:
+        return image_data_url(msg["image_hash"])
+    except FileNotFoundError:  # 整理で削除された画像は送らない
+        return None
+
+st.set_page_config(
+    page_title=PAGE_TITLE,
+    page_icon=":material/network_intelligence:",
+    initial_sidebar_state="expanded",
+    layout="wide",
 )
-""")
-conn.commit()
+st.title(PAGE_TITLE)
+
+client = get_openai_client()
+model_registry = get_model_registry()
+
+conn = get_connection(DATABASE_NAME, SCHEMA)
+c = conn.cursor()
 
 session_var_list = ["current_chat_id", "editing_chat_id", "new_chat"]
 for session_var in session_var_list:
@@ -66,21 +86,17 @@ def load_chats():
     return c.fetchall()
 
 def load_messages(chat_id):
-    c.execute("SELECT role, content, image, model_id FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,))
-    return [{"role": row[0], "content": row[1], "image": row[2], "model_id": row[3]} for row in c.fetchall()]
+    c.execute("SELECT id, role, content, image_hash, model_id FROM messages WHERE chat_id = ? ORDER BY id", (chat_id,))
+    return [{"id": row[0], "role": row[1], "content": row[2], "image_hash": row[3], "model_id": row[4]} for row in c.fetchall()]
 
 def create_new_chat_id():
-    c.execute("SELECT seq FROM sqlite_sequence WHERE name='chats'")
-    result = c.fetchone()
-    if result is None:
-        return 1
-    else:
-        return int(result[0]) + 1
+    # chats.id はTEXTの主キーなので、プロセスやセッションをまたいでも重複しないULIDを使う
+    return str(ULID())
 
-def save_chat_and_message(chat_id, user_message, image=None, model_id=None):
+def save_chat_and_message(chat_id, user_message, image_hash=None, model_id=None):
     now = datetime.now().isoformat()
     c.execute("INSERT INTO chats (id, title, created_at, last_model_id) VALUES (?, ?, ?, ?)", (chat_id, "新しいチャット", now, model_id))
-    c.execute("INSERT INTO messages (chat_id, role, content, image, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, "user", user_message, image, model_id))
+    c.execute("INSERT INTO messages (chat_id, role, content, image_hash, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, "user", user_message, image_hash, model_id))
     conn.commit()
 
 def update_chat_title(chat_id, new_title):
@@ -91,9 +107,9 @@ def delete_chat(chat_id):
     c.execute("UPDATE chats SET deleted = 1 WHERE id = ?", (chat_id,))
     conn.commit()
 
-def add_message(chat_id, role, content, image=None, model_id=None):
+def add_message(chat_id, role, content, image_hash=None, model_id=None):
     c.execute("UPDATE chats SET last_model_id = ? WHERE id = ?", (model_id, chat_id))
-    c.execute("INSERT INTO messages (chat_id, role, content, image, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, role, content, image, model_id))
+    c.execute("INSERT INTO messages (chat_id, role, content, image_hash, model_id) VALUES (?, ?, ?, ?, ?)", (chat_id, role, content, image_hash, model_id))
     conn.commit()
 
 def generate_title(prompt):
@@ -159,10 +175,9 @@ if chat_id:
             avatar = None
         with st.chat_message(msg["role"], avatar=avatar):
             st.text(msg["content"])
-            if msg["image"]: # 画像がある場合は表示
-                image = Image.open(io.BytesIO(msg["image"]))
-                st.image(image)
-            model_name = model_name_list[msg["model_id"]-1]
+            if msg["image_hash"]: # 画像がある場合はサムネイルを表示
+                show_image(msg["image_hash"], f"openai_{msg['id']}")
+            model_name = model_registry.get(msg["model_id"]).name
             if msg["role"] == "assistant":
                 if  "-search" in model_name:
                     icon = ":material/search:"
@@ -173,65 +188,47 @@ if chat_id:
                 st.badge(model_name, icon=icon, color=color)
 
     if prompt := st.chat_input("質問してみましょう", accept_file=True):
-        image_bytes = None
+        image_hash = None
         if prompt["files"]:
-            image_file = prompt["files"][0]
-            image = Image.open(image_file)
-            if image.width > 1920 or image.height > 1920:
-                image.thumbnail((1920, 1920))
-            image_bytes = io.BytesIO()
-            if image.mode == "RGBA":
-                image = image.convert("RGB")
-            image.save(image_bytes, format="JPEG")
-            image_bytes = image_bytes.getvalue()
+            try:
+                image_bytes, _ = ingest_image(prompt["files"][0].getvalue())
+            except ValueError as e:
+                st.error(str(e))
+                st.stop()
+            image_hash = get_image_store().put(image_bytes)
 
         # 新規チャットか既存チャットかで保存処理を分岐
         if st.session_state.new_chat:
-            save_chat_and_message(chat_id, prompt.text, image_bytes, st.session_state.model_id + 1)
+            save_chat_and_message(chat_id, prompt.text, image_hash, st.session_state.model_id + 1)
             st.session_state.new_chat = False
         else:
-            add_message(chat_id, "user", prompt.text, image_bytes, st.session_state.model_id + 1)
+            add_message(chat_id, "user", prompt.text, image_hash, st.session_state.model_id + 1)
         messages.append({
             "role": "user",
             "content": prompt.text,
-            "image": image_bytes
+            "image_hash": image_hash
         })
 
         # ユーザーメッセージ表示
         with st.chat_message("user"):
             st.text(prompt.text)
-            if image_bytes:
-                st.image(image_bytes)
+            if image_hash:
+                st.image(get_image_store().thumbnail_path(image_hash))
 
         # アシスタント応答生成
         with st.chat_message("assistant",avatar=":material/face_2:"):
-            processed_messages = []
-            for m in messages:
-                if m["image"]: # 画像付きメッセージの場合
-                    processed_messages.append({
-                        "role": m["role"],
-                        "content": [
-                            {"type": "text", "text": m["content"]},
-                            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64.b64encode(m['image']).decode('utf-8')}"}}
-                        ]
-                    })
-                else: # テキストのみのメッセージの場合
-                    processed_messages.append({
-                        "role": m["role"],
-                        "content": [
-                            {"type": "text", "text": m["content"]}
-                        ]
-                    })
-            if "-search-preview" in model_name_list[st.session_state.model_id]:
+            processed_messages = build_messages(messages, message_data_url)
+            model_name = model_registry.get(st.session_state.model_id + 1).name
+            if "-search-preview" in model_name:
                 stream = client.chat.completions.create(
-                    model=model_name_list[st.session_state.model_id],
+                    model=model_name,
                     web_search_options={"search_context_size": "medium"},
                     messages=processed_messages,
                     stream=True,
                 )
             else:
                 stream = client.chat.completions.create(
-                    model=model_name_list[st.session_state.model_id],
+                    model=model_name,
                     messages=processed_messages,
                     stream=True,
                 )
@@ -0,0 +1,34 @@
+"""OpenAI互換API（Groq・OpenAI）に送るメッセージの組み立て
+
+画像（メッセージの image_hash）はdata URLにして添付する。エンコード済みの文字列は各ページが
+画像のハッシュごとにキャッシュし、data_url(msg) で受け取る（画像が削除されていればNoneを返し、テキストだけを送る）。履歴中の画像は新しい方から image_limit 枚だけ添付し、
+それより古い画像付きメッセージはテキストだけを送る。
+"""
+import base64
+
+CONTEXT_IMAGE_LIMIT = 4  # 1回のリクエストに添付する画像の上限（Noneなら全て）
+
+def to_data_url(image: bytes, mime_type: str = "image/jpeg") -> str:
+    return f"data:{mime_type};base64,{base64.b64encode(image).decode('utf-8')}"
+
+def select_image_indexes(messages, use_image: bool = True, image_limit: int = CONTEXT_IMAGE_LIMIT) -> set:
+    """画像を添付するメッセージの番号（新しい方から image_limit 件）を返す"""
+    image_indexes = [i for i, m in enumerate(messages) if m["image_hash"]] if use_image else []
+    if image_limit is not None:
+        image_indexes = image_indexes[-image_limit:] if image_limit > 0 else []
+    return set(image_indexes)
+
+def build_messages(messages, data_url, use_image: bool = True, image_limit: int = CONTEXT_IMAGE_LIMIT):
+    """履歴をchat.completions用のメッセージ一覧に変換する（推論過程は送らない）"""
+    image_indexes = select_image_indexes(messages, use_image, image_limit)
+
+    processed_messages = []
+    for i, m in enumerate(messages):
+        if m["role"] == "reasoning":
+            continue
+        content = [{"type": "text", "text": m["content"]}]
+        url = data_url(m) if i in image_indexes else None  # 画像付きメッセージの場合
+        if url:
+            content.append({"type": "image_url", "image_url": {"url": url}})
+        processed_messages.append({"role": m["role"], "content": content})
+    return processed_messages
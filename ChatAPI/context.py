@@ -0,0 +1,87 @@
+"""Groqに送る会話履歴の組み立て
+
+モデルごとのトークン予算に収まるよう新しいメッセージから順に詰め、
+予算からあふれた古い履歴はチャットごとの要約（chats.summary）に畳み込む。
+要約済みのメッセージは読み込まないため、1ターンで扱うのは要約以降の分だけになる。
+"""
+import asyncio
+from sqlalchemy.orm import Session
+import models
+
+DEFAULT_CONTEXT_TOKENS = 8000
+SUMMARY_MODEL = "openai/gpt-oss-20b"
+SUMMARY_PROMPT = "あなたは会話の要約を作成するアシスタントです。これまでの要約と新しい会話を統合し、後の会話に必要な事実・決定事項・ユーザーの意図を残した簡潔な要約を日本語で作成してください。回答は要約だけでお願いします。"
+
+# 要約処理中のチャットID（同じチャットの要約を重複して走らせない）
+_folding_chats = set()
+
+def build_context(db: Session, chat_id: str, model_id: int):
+    """予算内に収めた履歴と、要約に畳み込むべき最後のメッセージIDを返す"""
+    chat = db.get(models.chats, chat_id)
+    summary = chat.summary if chat else None
+    summary_until_id = (chat.summary_until_id or 0) if chat else 0
+
+    model = models.get_model(model_id)
+    budget = (model.context_tokens if model else None) or DEFAULT_CONTEXT_TOKENS
+    used = models.estimate_tokens(summary)
+
+    msgs = models.load_context_messages(db, chat_id, after_id=summary_until_id)
+    kept = []
+    for msg in reversed(msgs):
+        tokens = msg.tokens if msg.tokens is not None else models.estimate_tokens(msg.content)
+        if kept and used + tokens > budget:
+            break
+        kept.append(msg)
+        used += tokens
+    kept.reverse()
+
+    fold_until_id = None
+    if len(kept) < len(msgs):
+        fold_until_id = msgs[len(msgs) - len(kept) - 1].id
+
+    groq_messages = []
+    if summary:
+        groq_messages.append({"role": "system", "content": f"これまでの会話の要約:\n{summary}"})
+    for msg in kept:
+        groq_messages.append({"role": msg.role, "content": msg.content})
+    return groq_messages, fold_until_id
+
+def _load_fold_target(chat_id: str, fold_until_id: int):
+    db = models.SessionLocal()
+    try:
+        chat = db.get(models.chats, chat_id)
+        if chat is None or (chat.summary_until_id or 0) >= fold_until_id:
+            return None, []
+        msgs = models.load_context_messages(db, chat_id, after_id=chat.summary_until_id or 0, until_id=fold_until_id)
+        return chat.summary, msgs
+    finally:
+        db.close()
+
+def _save_summary(chat_id: str, summary: str, fold_until_id: int):
+    db = models.SessionLocal()
+    try:
+        models.update_chat_summary(db, chat_id, summary, fold_until_id)
+    finally:
+        db.close()
+
+async def fold_into_summary(client, chat_id: str, fold_until_id: int):
+    """fold_until_idまでの未要約メッセージを既存の要約に統合して保存する"""
+    if chat_id in _folding_chats:
+        return
+    _folding_chats.add(chat_id)
+    try:
+        summary, msgs = await asyncio.to_thread(_load_fold_target, chat_id, fold_until_id)
+        if not msgs:
+            return
+        transcript = "\n".join(f"{msg.role}: {msg.content}" for msg in msgs)
+        response = await client.chat.completions.create(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"これまでの要約:\n{summary or 'なし'}\n\n新しい会話:\n{transcript}"}
+            ]
+        )
+        if response.choices and response.choices[0].message.content:
+            await asyncio.to_thread(_save_summary, chat_id, response.choices[0].message.content, fold_until_id)
+    finally:
+        _folding_chats.discard(chat_id)
@@ -0,0 +1,46 @@
+"""チャットに添付された画像の取り込み
+
+アップロードされた画像を、APIに送ってimage_storeに保存する形に揃える（free_chat・openai_chat・gemini_image で共通）。
+- 長辺が INGEST_MAX_SIZE 以下で向きの補正も要らないJPEG・PNGは、再エンコードせずそのまま使う
+- JPEGは Image.draft() でデコード時に1/2・1/4・1/8へ縮小し、12MPの写真を全画素デコードしない
+- EXIFの向きは画素に反映する（再エンコードでEXIFが落ちても横倒しにならないように）
+- 再エンコードするときは、透過のある画像はPNG、それ以外はJPEG（品質 INGEST_JPEG_QUALITY）にする
+"""
+import io
+import math
+from PIL import Image, ImageOps, ExifTags
+from image_store import guess_mime_type
+
+INGEST_MAX_SIZE = 1920  # 保存する画像の長辺（px）
+INGEST_JPEG_QUALITY = 85
+_PASSTHROUGH_FORMATS = ("JPEG", "PNG")
+
+def _has_alpha(image: Image.Image) -> bool:
+    return image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+
+def ingest_image(data: bytes, max_size: int = INGEST_MAX_SIZE) -> tuple:
+    """画像のバイト列を縮小・向き補正して (バイト列, MIMEタイプ) を返す（画像でなければValueError）"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        with image:
+            orientation = image.getexif().get(ExifTags.Base.Orientation, 1)
+            if image.format in _PASSTHROUGH_FORMATS and max(image.size) <= max_size and orientation == 1:
+                return data, guess_mime_type(data)
+            if image.format == "JPEG":
+                # 長辺がmax_sizeを下回らない範囲で縮小してデコードする（draftは縦横の小さい方の比率で倍率を選ぶ）
+                scale = max_size / max(image.size)
+                if scale < 1:
+                    image.draft("RGB", (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+    except (OSError, Image.DecompressionBombError):
+        # UnidentifiedImageErrorや途中で切れたファイルのデコード失敗（OSError）もここで扱う
+        raise ValueError("画像として読み込めないファイルです。")
+    buf = io.BytesIO()
+    if _has_alpha(image):
+        image.save(buf, format="PNG")
+        return buf.getvalue(), "image/png"
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    image.save(buf, format="JPEG", quality=INGEST_JPEG_QUALITY)
+    return buf.getvalue(), "image/jpeg"
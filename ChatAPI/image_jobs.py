@@ -0,0 +1,234 @@
+"""画像生成ジョブのキューとバックグラウンドワーカー
+
+gemini_image.py はプロンプトを保存したら生成をジョブとしてDBの image_jobs テーブルに登録し、
+すぐに画面へ戻る。生成はワーカースレッド（最大 IMAGE_JOB_WORKERS 件を並行）が行い、
+結果の画像をチャットのメッセージとして保存してからジョブを削除する。ブラウザを閉じたり
+再読み込みしたりしても結果は失われず、プロセスが再起動したときは終わっていないジョブを登録し直す。
+
+1つのチャットのジョブはプロンプトを送った順に生成する（同じプロンプトの複数枚だけは並行する）。
+生成中に次のプロンプトが送られても、その生成は前の結果を直前の画像として使える。
+結果の行は reply_to にもとのプロンプトのIDを持ち、表示や直前の画像の検索は COALESCE(reply_to, id) の順で行う
+（結果の行のIDは後から送ったプロンプトより大きくなることがあるため）。
+
+生成時に送るのは、直前の画像（生成・アップロードのうち最新のもの）と直近 CONTEXT_TEXT_TURNS 件の
+プロンプトだけにして、編集を繰り返しても1回のリクエストの大きさが一定になるようにする。
+"""
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from google.genai import types
+from image_store import ImageStore, ImageCache, guess_mime_type
+from sqlite_settings import SQLITE_PRAGMAS
+
+IMAGE_JOB_WORKERS = 2
+CONTEXT_TEXT_TURNS = 4  # 生成時に送る直近のプロンプトの数（今回の分を含む）
+JOB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS image_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER,
+    message_id INTEGER,
+    status TEXT,
+    error TEXT,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_image_jobs_chat_id ON image_jobs(chat_id);
+"""
+
+def add_reply_to_column(conn: sqlite3.Connection):
+    """messagesテーブルに、結果の行がどのプロンプトへの応答かを示す reply_to 列がなければ追加する"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+    if columns and "reply_to" not in columns:
+        try:
+            conn.execute("ALTER TABLE messages ADD COLUMN reply_to INTEGER")
+            conn.commit()
+        except sqlite3.OperationalError:
+            # 別のプロセスが先に追加した場合
+            conn.rollback()
+
+class ImageJobRunner:
+    """image_jobs テーブルのジョブを、上限つきのスレッドプールで順に生成する
+
+    ジョブの状態は queued（待ち）→ running（生成中）→ 完了で削除、失敗時は error。
+    message_id は生成のもとになるユーザーメッセージ。
+    チャットごとに、前のプロンプトのジョブが終わるまで次のプロンプトのジョブはプールに渡さない。
+    """
+
+    def __init__(self, database_name: str, client, model: str, store: ImageStore = None, workers: int = IMAGE_JOB_WORKERS):
+        self.database_name = database_name
+        self.client = client
+        self.model = model
+        self.store = store or ImageStore()
+        self.image_cache = ImageCache(self.store)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-job")
+        self._lock = threading.Lock()
+        self._waiting = {}  # chat_id -> プールに渡していない (message_id, job_id) の列
+        self._running = {}  # chat_id -> プールに渡したジョブの数
+        conn = self._connect()
+        try:
+            conn.executescript(JOB_SCHEMA)
+            add_reply_to_column(conn)
+            # 前回のプロセスで生成途中だったジョブは最初からやり直す
+            conn.execute("UPDATE image_jobs SET status = 'queued' WHERE status = 'running'")
+            conn.commit()
+            pending = conn.execute("SELECT id, chat_id, message_id FROM image_jobs WHERE status = 'queued' ORDER BY id").fetchall()
+        finally:
+            conn.close()
+        self._enqueue(pending)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.database_name)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def submit(self, chat_id, message_id, count: int = 1) -> list:
+        """message_idのプロンプトでcount枚の生成ジョブを登録し、ジョブIDを返す"""
+        now = datetime.now().isoformat()
+        conn = self._connect()
+        try:
+            job_ids = [
+                conn.execute(
+                    "INSERT INTO image_jobs (chat_id, message_id, status, created_at) VALUES (?, ?, 'queued', ?) RETURNING id",
+                    (chat_id, message_id, now),
+                ).fetchone()[0]
+                for _ in range(count)
+            ]
+            conn.commit()
+        finally:
+            conn.close()
+        self._enqueue([(job_id, chat_id, message_id) for job_id in job_ids])
+        return job_ids
+
+    def _enqueue(self, jobs):
+        """(ジョブID, チャットID, メッセージID) の一覧を、チャットごとの待ち行列に加える"""
+        with self._lock:
+            for job_id, chat_id, message_id in jobs:
+                self._waiting.setdefault(chat_id, deque()).append((message_id, job_id))
+            for chat_id in {chat_id for _, chat_id, _ in jobs}:
+                self._dispatch(chat_id)
+
+    def _dispatch(self, chat_id):
+        """チャットに生成中のジョブがなければ、次のプロンプトのジョブをまとめてプールに渡す（_lockを持って呼ぶ）"""
+        waiting = self._waiting.get(chat_id)
+        if self._running.get(chat_id) or not waiting:
+            return
+        message_id = waiting[0][0]
+        while waiting and waiting[0][0] == message_id:
+            _, job_id = waiting.popleft()
+            self._running[chat_id] = self._running.get(chat_id, 0) + 1
+            self.pool.submit(self._run_in_order, chat_id, job_id)
+        if not waiting:
+            del self._waiting[chat_id]
+
+    def _run_in_order(self, chat_id, job_id):
+        try:
+            self._run(job_id)
+        finally:
+            with self._lock:
+                self._running[chat_id] -= 1
+                if not self._running[chat_id]:
+                    del self._running[chat_id]
+                    self._dispatch(chat_id)
+
+    def jobs(self, chat_id) -> list:
+        """チャットの未完了・失敗したジョブを返す"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, status, error FROM image_jobs WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+        finally:
+            conn.close()
+        return [{"id": row[0], "status": row[1], "error": row[2]} for row in rows]
+
+    def dismiss(self, job_id):
+        """失敗したジョブを一覧から消す"""
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM image_jobs WHERE id = ? AND status = 'error'", (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _image_part(self, image_hash):
+        # PIL画像を渡すとSDKがリクエストのたびにPNGへ変換し直すため、保存済みのバイト列をそのまま送る
+        data = self.image_cache.get(image_hash)
+        return types.Part.from_bytes(data=data, mime_type=guess_mime_type(data))
+
+    def _build_contents(self, conn, chat_id, message_id):
+        """直近のプロンプトと直前の画像を返す（もとのメッセージが削除されていればNone）"""
+        rows = conn.execute(
+            "SELECT id, content, image_hash FROM messages WHERE chat_id = ? AND role = 'user' AND id <= ? ORDER BY id DESC LIMIT ?",
+            (chat_id, message_id, CONTEXT_TEXT_TURNS),
+        ).fetchall()
+        if not rows or rows[0][0] != message_id:
+            return None
+        rows.reverse()
+        *earlier, (_, prompt, upload_hash) = rows
+        contents = [content for _, content, _ in earlier]
+        # 編集の対象は、今回のプロンプトより前で最後に出てきた画像（前のプロンプトの結果は reply_to で判断する）
+        previous = conn.execute(
+            "SELECT image_hash FROM messages WHERE chat_id = ? AND COALESCE(reply_to, id) < ? AND image_hash IS NOT NULL "
+            "ORDER BY COALESCE(reply_to, id) DESC, id DESC LIMIT 1",
+            (chat_id, message_id),
+        ).fetchone()
+        if previous and self.store.exists(previous[0]):  # 整理で削除された画像は送らない
+            contents.append(self._image_part(previous[0]))
+        if upload_hash:
+            contents.append(self._image_part(upload_hash))
+        contents.append(prompt)
+        return contents
+
+    def _generate(self, contents):
+        response = self.client.models.generate_content(
+            model=self.model,
+            contents=contents,
+            config=types.GenerateContentConfig(response_modalities=['TEXT', 'IMAGE']),
+        )
+        answer = None
+        image_bytes = None
+        for part in response.candidates[0].content.parts:
+            if part.text is not None:
+                answer = part.text
+            elif part.inline_data is not None:
+                image_bytes = part.inline_data.data
+        return answer, image_bytes
+
+    def _run(self, job_id):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "UPDATE image_jobs SET status = 'running' WHERE id = ? AND status = 'queued' RETURNING chat_id, message_id",
+                (job_id,),
+            ).fetchone()
+            conn.commit()
+            if row is None:  # 待っている間にチャットごと削除された
+                return
+            chat_id, message_id = row
+            try:
+                contents = self._build_contents(conn, chat_id, message_id)
+                if contents is None:  # もとのメッセージが削除された
+                    conn.execute("DELETE FROM image_jobs WHERE id = ?", (job_id,))
+                    conn.commit()
+                    return
+                answer, image_bytes = self._generate(contents)
+                if image_bytes is None:
+                    raise RuntimeError(f"画像が生成されませんでした。{answer or ''}")
+                image_hash = self.store.put(image_bytes)
+            except Exception as e:
+                # 保存の失敗も含め、ジョブを running のまま残さない
+                conn.execute("UPDATE image_jobs SET status = 'error', error = ? WHERE id = ?", (str(e), job_id))
+                conn.commit()
+                return
+            now = datetime.now().isoformat()
+            # 生成中にもとのメッセージが削除されていたら結果は保存しない
+            conn.execute(
+                "INSERT INTO messages (chat_id, role, content, image_hash, reply_to) "
+                "SELECT ?, 'assistant', ?, ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE id = ?)",
+                (chat_id, answer, image_hash, message_id, message_id),
+            )
+            conn.execute("UPDATE chats SET used_at = ? WHERE id = ?", (now, chat_id))
+            conn.execute("DELETE FROM image_jobs WHERE id = ?", (job_id,))
+            conn.commit()
+        finally:
+            conn.close()
@@ -0,0 +1,183 @@
+"""画像ファイルのコンテンツアドレス型ストア
+
+画像はSHA-256をファイル名にして IMAGE_STORE_DIR に保存し、DBの行にはハッシュ（image_hash）だけを持つ。
+同じ画像は1ファイルにまとまる。表示用のサムネイルは保存時に作り、thumbs/<サイズ>/ に置く
+（保存時に作っていない古い画像やサイズは、最初に要求されたときに作る）。
+サムネイルはJPEGにする。st.image はJPEG・PNG・GIF以外（WebPなど）を再実行のたびにJPEGへ変換し直すため。
+FastAPIアプリ（models.py）とStreamlitの各チャットページで共通に使う。
+FastAPIアプリの依存にはPillowがないため、PILはサムネイルを作るときにだけ読み込む
+（Pillowがなければサムネイルは作らず、画像の保存・読み込み・削除だけを行う）。
+"""
+import io
+import os
+import re
+import sqlite3
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+IMAGE_STORE_DIR = os.getenv("IMAGE_STORE_DIR", "/data/images")
+THUMBNAIL_SIZE = 768  # 履歴に表示するサムネイルの長辺（px）
+THUMBNAIL_QUALITY = 85
+IMAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # ImageCacheが保持する画像の合計サイズ
+_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+# 先頭のバイト列から判定する画像形式（ファイル名に拡張子を付けないため）
+_MIME_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF8", "image/gif"),
+)
+
+def is_image_hash(value: str) -> bool:
+    return bool(value) and _HASH_PATTERN.fullmatch(value) is not None
+
+def guess_mime_type(data: bytes) -> str:
+    for signature, mime_type in _MIME_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+def _write_atomic(path: str, data: bytes):
+    # 書き込み途中のファイルを他のプロセスが読まないよう、一時ファイルから置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+class ImageStore:
+    """SHA-256をキーにした画像ファイルの保存先"""
+
+    def __init__(self, directory: str = IMAGE_STORE_DIR):
+        self.directory = directory
+
+    def path(self, image_hash: str) -> str:
+        return os.path.join(self.directory, image_hash[:2], image_hash)
+
+    def put(self, data: bytes) -> str:
+        """画像とサムネイルを保存してハッシュを返す（同じ内容のファイルがあれば書き込まない）"""
+        image_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(image_hash)
+        try:
+            # 既にあるファイルは更新時刻を新しくし、参照する行が書かれる前に回収されないようにする
+            os.utime(path)
+        except FileNotFoundError:
+            _write_atomic(path, data)
+            self.thumbnail_path(image_hash)
+        return image_hash
+
+    def get(self, image_hash: str) -> bytes:
+        with open(self.path(image_hash), "rb") as f:
+            return f.read()
+
+    def exists(self, image_hash: str) -> bool:
+        return is_image_hash(image_hash) and os.path.exists(self.path(image_hash))
+
+    def hashes(self):
+        """保存されている画像のハッシュと最終更新時刻を返す"""
+        if not os.path.isdir(self.directory):
+            return
+        for prefix in os.scandir(self.directory):
+            if not prefix.is_dir() or len(prefix.name) != 2:
+                continue
+            for entry in os.scandir(prefix.path):
+                if is_image_hash(entry.name):
+                    yield entry.name, entry.stat().st_mtime
+
+    def remove(self, image_hash: str) -> int:
+        """画像とそのサムネイルを削除し、減ったバイト数を返す"""
+        paths = [self.path(image_hash)]
+        thumbs_dir = os.path.join(self.directory, "thumbs")
+        if os.path.isdir(thumbs_dir):
+            paths += [os.path.join(entry.path, f"{image_hash}.jpg") for entry in os.scandir(thumbs_dir)]
+        freed = 0
+        for path in paths:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            freed += size
+        return freed
+
+    def thumbnail_path(self, image_hash: str, size: int = THUMBNAIL_SIZE) -> str:
+        """長辺size以下のJPEGサムネイルのパスを返す（なければ生成する）
+
+        元の画像が削除されているか、画像として読み込めないか、Pillowがなければ None を返す。
+        """
+        path = os.path.join(self.directory, "thumbs", str(size), f"{image_hash}.jpg")
+        if not os.path.exists(path):
+            if not os.path.exists(self.path(image_hash)):
+                return None
+            try:
+                from PIL import Image
+            except ImportError:
+                return None
+            try:
+                with Image.open(self.path(image_hash)) as image:
+                    image.thumbnail((size, size))
+                    if image.mode not in ("RGB", "L"):
+                        image = image.convert("RGB")
+                    buf = io.BytesIO()
+                    image.save(buf, format="JPEG", quality=THUMBNAIL_QUALITY)
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                # 旧形式のBLOBなどで壊れた画像があっても、保存や移行は止めない
+                print(f"サムネイルを作れませんでした: {image_hash}: {e}")
+                return None
+            _write_atomic(path, buf.getvalue())
+        return path
+
+class ImageCache:
+    """ストアの画像をハッシュごとにメモリに保持するLRUキャッシュ（複数スレッドから使える）"""
+
+    def __init__(self, store: ImageStore, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_hash: str) -> bytes:
+        with self._lock:
+            data = self._entries.get(image_hash)
+            if data is not None:
+                self._entries.move_to_end(image_hash)
+                return data
+        data = self.store.get(image_hash)
+        with self._lock:
+            if image_hash not in self._entries:
+                self._entries[image_hash] = data
+                self.total += len(data)
+            while self.total > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.total -= len(evicted)
+        return data
+
+def migrate_sqlite_blobs(conn: sqlite3.Connection, store: ImageStore, table: str = "messages", batch: int = 50) -> int:
+    """image列のBLOBをストアへ移してimage_hash列にハッシュを入れ、移した件数を返す"""
+    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if not columns:
+        return 0
+    if "image_hash" not in columns:
+        try:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN image_hash TEXT")
+            conn.commit()
+        except sqlite3.OperationalError:
+            # 別のプロセスが先に追加した場合
+            conn.rollback()
+    if "image" not in columns:
+        return 0
+    moved = 0
+    while True:
+        rows = conn.execute(f"SELECT id, image FROM {table} WHERE image IS NOT NULL LIMIT ?", (batch,)).fetchall()
+        if not rows:
+            return moved
+        conn.executemany(
+            f"UPDATE {table} SET image_hash = ?, image = NULL WHERE id = ?",
+            [(store.put(image), message_id) for message_id, image in rows],
+        )
+        conn.commit()
+        moved += len(rows)
@@ -0,0 +1,28 @@
+"""チャット履歴の画像表示
+
+履歴ではサムネイルだけを送り、元の解像度の画像はボタンで開いたときだけ送る。
+再実行のたびにブラウザへ送る量が、画像の大きさではなくメッセージの数で決まるようにする。
+"""
+import streamlit as st
+from page_resources import get_image_store
+
+@st.fragment
+def show_image(image_hash: str, key: str):
+    # 開閉ではこの画像だけを再実行する
+    expanded = st.session_state.setdefault("expanded_images", set())
+    store = get_image_store()
+    thumbnail = store.thumbnail_path(image_hash)
+    if thumbnail is None:
+        # 整理（maintenance.py）で削除された画像や、読み込めない画像
+        st.caption("画像を表示できません")
+        return
+    if key in expanded:
+        st.image(store.path(image_hash))
+        if st.button("縮小", icon=":material/close_fullscreen:", key=f"shrink_{key}", type="tertiary"):
+            expanded.discard(key)
+            st.rerun(scope="fragment")
+    else:
+        st.image(thumbnail)
+        if st.button("元のサイズで表示", icon=":material/open_in_full:", key=f"expand_{key}", type="tertiary"):
+            expanded.add(key)
+            st.rerun(scope="fragment")
@@ -0,0 +1,205 @@
+"""チャットDBの整理（一括削除・論理削除の物理削除・画像の回収・VACUUM）
+
+各チャットDBに対して次の順に実行し、減ったバイト数を報告する。
+1. 条件（最終利用日時・タイトル）に合うチャットをメッセージごとバッチで削除する
+2. deleted = 1 のチャットと、チャットが存在しないメッセージを削除する
+3. どのDBからも参照されなくなった画像を image_store から削除する
+4. incremental VACUUMで空きページをファイルから切り詰める
+
+CLI（ChatAPIディレクトリで実行）:
+    uv run python maintenance.py                       # 論理削除の整理とVACUUMのみ
+    uv run python maintenance.py --older-than 180      # 180日以上使われていないチャットも削除
+    uv run python maintenance.py --title "テスト%" --database /data/with_image.db
+
+FastAPIアプリ（app.py）は MAINTENANCE_INTERVAL ごとに run_if_due() をバックグラウンドで呼ぶ。
+"""
+import os
+import time
+import fcntl
+import sqlite3
+import argparse
+from datetime import datetime, timedelta
+# image_storeはPILを読み込まない（app.pyの依存にPillowがないため、起動時にこのモジュールも読み込まれる）
+from image_store import ImageStore
+from models import DATABASE_URL, SIDEBAR_CACHE
+
+# image_store を共有しているDB（画像の回収では、対象外のDBも含めて全てから参照を集める）
+CHAT_DATABASES = [
+    DATABASE_URL.removeprefix("sqlite:///"),  # FastAPIアプリ
+    "/data/free_chat_history.db",
+    "/data/chat_history.db",
+    "/data/with_image.db",
+]
+MAINTENANCE_LOCK = os.getenv("MAINTENANCE_LOCK", "/data/.maintenance.lock")
+# 自動実行で削除するチャットの経過日数（未設定なら年齢による削除はしない）
+CHAT_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "0")) or None
+DELETE_BATCH = 200  # 1トランザクションで削除するチャット数
+IMAGE_GRACE_SECONDS = 3600  # 保存直後でまだ行が書かれていない画像を消さないための猶予
+
+def _connect(database: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA busy_timeout=15000")
+    return conn
+
+def _columns(conn: sqlite3.Connection, table: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+def _file_size(database: str) -> int:
+    return sum(os.path.getsize(path) for path in (database, f"{database}-wal") if os.path.exists(path))
+
+def ensure_indexes(conn: sqlite3.Connection):
+    # チャット単位の削除・読み込みがmessagesを全件走査しないようにする（既にあれば作らない）
+    for row in conn.execute("PRAGMA index_list(messages)").fetchall():
+        first_column = conn.execute(f"PRAGMA index_info({row[1]})").fetchone()
+        if first_column and first_column[2] == "chat_id":
+            return
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id, id)")
+    conn.commit()
+
+def _invalidate_sidebar(conn: sqlite3.Connection):
+    # FastAPIアプリのDBでは、各ワーカーのサイドバーキャッシュを無効にする（models.bump_cache_versionと同じ更新）
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cache_versions'").fetchone():
+        conn.execute(
+            "INSERT INTO cache_versions (name, version) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET version = version + 1",
+            (SIDEBAR_CACHE,),
+        )
+
+def _chat_filter(conn: sqlite3.Connection, database: str, older_than_days: int = None, title: str = None):
+    """削除するチャットのWHERE句とパラメータを返す（条件がなければNone）"""
+    conditions, params = [], []
+    if older_than_days is not None:
+        columns = _columns(conn, "chats")
+        column = "used_at" if "used_at" in columns else "created_at" if "created_at" in columns else None
+        if column is None:
+            print(f"{database}: 日時の列がないため、チャットの削除は行いません")
+            return None
+        conditions.append(f"{column} < ?")
+        params.append((datetime.now() - timedelta(days=older_than_days)).isoformat())
+    if title is not None:
+        conditions.append("title LIKE ?")
+        params.append(title)
+    if not conditions:
+        return None
+    return " AND ".join(conditions), params
+
+def delete_chats(conn: sqlite3.Connection, where: str, params=(), batch: int = DELETE_BATCH) -> dict:
+    """whereに合うチャットとそのメッセージをbatch件ずつ削除し、削除した件数を返す"""
+    chat_ids = [row[0] for row in conn.execute(f"SELECT id FROM chats WHERE {where}", params)]
+    deleted = {"chats": 0, "messages": 0}
+    for i in range(0, len(chat_ids), batch):
+        # 短いトランザクションに分けて、ページからの書き込みを長く待たせない
+        ids = chat_ids[i:i + batch]
+        marks = ",".join("?" * len(ids))
+        deleted["messages"] += conn.execute(f"DELETE FROM messages WHERE chat_id IN ({marks})", ids).rowcount
+        deleted["chats"] += conn.execute(f"DELETE FROM chats WHERE id IN ({marks})", ids).rowcount
+        _invalidate_sidebar(conn)
+        conn.commit()
+    return deleted
+
+def purge_deleted(conn: sqlite3.Connection, batch: int = DELETE_BATCH) -> dict:
+    """論理削除されたチャットと、チャットが存在しないメッセージを削除する"""
+    deleted = {"chats": 0, "messages": 0}
+    if "deleted" in _columns(conn, "chats"):
+        deleted = delete_chats(conn, "deleted = 1", batch=batch)
+    deleted["messages"] += conn.execute(
+        "DELETE FROM messages WHERE chat_id NOT IN (SELECT id FROM chats)"
+    ).rowcount
+    # free_chat.py の応答ごとの計測値
+    if _columns(conn, "reply_stats"):
+        conn.execute("DELETE FROM reply_stats WHERE message_id NOT IN (SELECT id FROM messages)")
+    conn.commit()
+    return deleted
+
+def vacuum(conn: sqlite3.Connection):
+    """空きページをファイルから切り詰める（初回だけ全体をVACUUMしてincremental方式に切り替える）"""
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        # execute()では1ページずつしか進まないため、最後まで実行されるexecutescript()を使う
+        conn.executescript("PRAGMA incremental_vacuum;")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+def collect_images(store: ImageStore, databases, grace: float = IMAGE_GRACE_SECONDS) -> dict:
+    """databasesのどのDBからも参照されていない画像を削除する（ストアを共有する全てのDBを渡すこと）"""
+    referenced = set()
+    for database in databases:
+        if not os.path.exists(database):
+            continue
+        conn = _connect(database)
+        try:
+            if "image_hash" in _columns(conn, "messages"):
+                referenced.update(row[0] for row in conn.execute(
+                    "SELECT DISTINCT image_hash FROM messages WHERE image_hash IS NOT NULL"
+                ))
+        finally:
+            conn.close()
+    removed = {"images": 0, "bytes": 0}
+    cutoff = time.time() - grace
+    for image_hash, mtime in list(store.hashes()):
+        if image_hash not in referenced and mtime < cutoff:
+            removed["bytes"] += store.remove(image_hash)
+            removed["images"] += 1
+    return removed
+
+def maintain_database(database: str, older_than_days: int = None, title: str = None) -> dict:
+    """1つのDBを整理し、削除件数と減ったバイト数を返す"""
+    size_before = _file_size(database)
+    conn = _connect(database)
+    try:
+        ensure_indexes(conn)
+        report = {"chats": 0, "messages": 0}
+        chat_filter = _chat_filter(conn, database, older_than_days, title)
+        if chat_filter is not None:
+            report = delete_chats(conn, *chat_filter)
+        for key, value in purge_deleted(conn).items():
+            report[key] += value
+        vacuum(conn)
+    finally:
+        conn.close()
+    report["bytes"] = size_before - _file_size(database)
+    return report
+
+def run(databases=CHAT_DATABASES, older_than_days: int = None, title: str = None) -> dict:
+    reports = {}
+    for database in databases:
+        if not os.path.exists(database):
+            continue
+        report = maintain_database(database, older_than_days, title)
+        print(f"{database}: チャット{report['chats']}件・メッセージ{report['messages']}件を削除、"
+              f"{report['bytes'] / 1024:.1f}KB減少")
+        reports[database] = report
+    # 整理の対象に選ばなかったDBの画像も消さないよう、参照は全てのDBから集める
+    images = collect_images(ImageStore(), list(dict.fromkeys([*CHAT_DATABASES, *databases])))
+    print(f"画像{images['images']}件を削除、{images['bytes'] / 1024:.1f}KB減少")
+    reports["images"] = images
+    return reports
+
+def run_if_due(interval: float) -> bool:
+    """前回の実行からinterval秒経っていれば整理を実行する（複数ワーカーのうち1つだけが実行する）"""
+    os.makedirs(os.path.dirname(MAINTENANCE_LOCK), exist_ok=True)
+    with open(MAINTENANCE_LOCK, "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False  # 他のワーカーが実行中
+        # 前回の実行時刻はロックファイルの更新時刻で記録する（作成直後は実行する）
+        if os.path.getsize(MAINTENANCE_LOCK) and time.time() - os.path.getmtime(MAINTENANCE_LOCK) < interval:
+            return False
+        run(older_than_days=CHAT_RETENTION_DAYS)
+        lock.truncate(0)
+        lock.write(datetime.now().isoformat())
+        lock.flush()
+        return True
+
+def main():
+    parser = argparse.ArgumentParser(description="チャットDBの整理")
+    parser.add_argument("--older-than", type=int, metavar="DAYS", help="指定日数以上使われていないチャットを削除する")
+    parser.add_argument("--title", help="タイトルがLIKEパターンに合うチャットを削除する")
+    parser.add_argument("--database", action="append", help="対象のDB（複数指定可、省略時は全て）")
+    args = parser.parse_args()
+    run(args.database or CHAT_DATABASES, args.older_than, args.title)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+"""モデルカタログの共有レジストリ
+
+modelsテーブル（または固定のモデル一覧）を起動時に一度だけ読み込み、
+モデルIDからの参照を辞書引きで返す。カタログを更新したときは reload() を呼ぶ。
+FastAPIアプリ（app.py）とStreamlitの各チャットページで共通に使う。
+
+RemoteModelList はAPIのモデル一覧をTTL付きで保持し、期限切れ後も古い一覧を返しながら
+バックグラウンドで取り直す。取得した一覧は add_sqlite_models() でmodelsテーブルに反映できる。
+"""
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+ModelInfo = namedtuple("ModelInfo", ["id", "name", "display", "image", "reasoning", "context_tokens"])
+# 古いDBに存在しない列は既定値で補う
+COLUMN_DEFAULTS = {"image": False, "reasoning": False, "context_tokens": None}
+# チャットに使えないモデル（音声認識・音声合成・ガードレール）はmodelsテーブルに追加しない
+NON_CHAT_MODEL_KEYWORDS = ("whisper", "tts", "guard")
+MODEL_LIST_RETRY_INTERVAL = 60  # 取得に失敗した後、次に取り直すまでの秒数
+
+class ModelRegistry:
+    """読み込み済みのモデル一覧を不変の辞書として保持する"""
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._by_id = MappingProxyType({})
+        self._by_name = MappingProxyType({})
+        self._ordered = ()
+        self._image_ids = frozenset()
+
+    @classmethod
+    def from_rows(cls, rows):
+        registry = cls(lambda: rows)
+        registry.reload()
+        return registry
+
+    def reload(self):
+        """ローダーからモデル一覧を読み直し、参照用の辞書をまとめて差し替える"""
+        with self._lock:
+            ordered = tuple(sorted(self._loader(), key=lambda m: m.id))
+            by_id = MappingProxyType({m.id: m for m in ordered})
+            by_name = MappingProxyType({m.name: m for m in ordered})
+            image_ids = frozenset(m.id for m in ordered if m.image)
+            self._by_id, self._by_name, self._ordered, self._image_ids = by_id, by_name, ordered, image_ids
+        return self
+
+    def get(self, model_id, default=None):
+        return self._by_id.get(model_id, default)
+
+    def by_name(self, name: str, default=None):
+        return self._by_name.get(name, default)
+
+    def all(self):
+        return self._ordered
+
+    @property
+    def image_model_ids(self):
+        return self._image_ids
+
+def load_sqlite_models(database_name: str):
+    """sqlite3で直接modelsテーブルを読み込む（Streamlitページ用）"""
+    conn = sqlite3.connect(database_name)
+    try:
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(models)")}
+        columns = [column if column in existing else "NULL" for column in ModelInfo._fields]
+        rows = conn.execute(f"SELECT {', '.join(columns)} FROM models ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    models = []
+    for row in rows:
+        values = dict(zip(ModelInfo._fields, row))
+        for column, default in COLUMN_DEFAULTS.items():
+            if column not in existing or values[column] is None:
+                values[column] = default
+        values["image"] = bool(values["image"])
+        values["reasoning"] = bool(values["reasoning"])
+        models.append(ModelInfo(**values))
+    return models
+
+def add_sqlite_models(database_name: str, names) -> int:
+    """modelsテーブルにないチャット用モデルを追加し、追加した件数を返す（既存の行は変更しない）"""
+    conn = sqlite3.connect(database_name)
+    try:
+        if not conn.execute("PRAGMA table_info(models)").fetchall():
+            return 0
+        existing = {row[0] for row in conn.execute("SELECT name FROM models")}
+        new_names = [
+            name for name in names
+            if name not in existing and not any(keyword in name for keyword in NON_CHAT_MODEL_KEYWORDS)
+        ]
+        conn.executemany("INSERT INTO models (name, display) VALUES (?, ?)", [(name, name) for name in new_names])
+        conn.commit()
+    finally:
+        conn.close()
+    return len(new_names)
+
+class RemoteModelList:
+    """APIから取得したモデル名の一覧をTTL付きで保持する
+
+    get() は常に手元の一覧をすぐに返し、期限切れならバックグラウンドで取り直す。
+    取り直した一覧は on_update(names) に渡す。取得に失敗したときは retry_interval 秒
+    （ttlの方が短ければttl秒）待ってから取り直す。
+    """
+
+    def __init__(self, fetch, ttl: float, on_update=None, retry_interval: float = MODEL_LIST_RETRY_INTERVAL):
+        self._fetch = fetch
+        self._ttl = ttl
+        self._retry_interval = min(retry_interval, ttl)
+        self._on_update = on_update
+        self._lock = threading.Lock()
+        self._names = ()
+        self._next_fetch_at = None  # 次に取り直す時刻（Noneならまだ一度も取得していない）
+        self._refreshing = False
+
+    def get(self):
+        with self._lock:
+            expired = self._next_fetch_at is None or time.monotonic() >= self._next_fetch_at
+            names = self._names
+        if expired:
+            self.refresh_async()
+        return names
+
+    def refresh_async(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def _refresh(self):
+        try:
+            names = tuple(sorted(self._fetch()))
+            if self._on_update is not None:
+                self._on_update(names)
+            with self._lock:
+                self._names = names
+                self._next_fetch_at = time.monotonic() + self._ttl
+        except Exception as e:
+            print(f"モデル一覧の取得に失敗: {e}")
+            with self._lock:
+                self._next_fetch_at = time.monotonic() + self._retry_interval
+        finally:
+            with self._lock:
+                self._refreshing = False
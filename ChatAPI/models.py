@@ -1,14 +1,26 @@
-from sqlalchemy import Column, Integer, String, BLOB, Boolean, create_engine
-from sqlalchemy.orm import declarative_base, sessionmaker, Session
+import os
+import time
+import threading
+from collections import namedtuple
+from sqlalchemy import Column, Integer, String, BLOB, Boolean, Float, Index, create_engine, event, inspect, text, func
+from sqlalchemy.orm import declarative_base, sessionmaker, Session, deferred
 from sqlalchemy import ForeignKey
+from model_registry import ModelInfo, ModelRegistry
+from image_store import ImageStore, migrate_sqlite_blobs
 
 Base = declarative_base()
-DATABASE_URL = "sqlite:///../data/free_chat.db"
+DATABASE_URL = os.getenv("CHAT_DATABASE_URL", "sqlite:///../data/free_chat.db")
+MESSAGE_PAGE_SIZE = 50
+# 複数ワーカーから同じDBファイルへ書き込むための設定（ロック待ちはミリ秒）
+SQLITE_BUSY_TIMEOUT = 15000
 
 class chats(Base):
   __tablename__ = 'chats'
   id = Column(String, primary_key=True, unique=True, index=True)
   title = Column(String)
+  summary = Column(String, nullable=True)  # 切り詰めた古い履歴の要約
+  summary_until_id = Column(Integer, default=0)  # 要約に含めた最後のメッセージID
+  title_pending = Column(Boolean, default=False)  # タイトル生成待ち（どのワーカーからも参照できるようDBに持つ）
 
 class messages(Base):
   __tablename__ = 'messages'
@@ -16,8 +28,16 @@ class messages(Base):
   chat_id = Column(String, ForeignKey('chats.id'))
   role = Column(String)
   content = Column(String)
-  image = Column(BLOB, nullable=True)
+  image = deferred(Column(BLOB, nullable=True))  # 旧形式の画像（起動時にimage_storeへ移す）
+  image_hash = Column(String, nullable=True)  # image_storeに保存した画像のSHA-256
   model_id = Column(Integer, ForeignKey('models.id'))
+  tokens = Column(Integer, nullable=True)  # 保存時に見積もったトークン数
+  is_partial = Column(Boolean, default=False)  # ストリーミング途中（または中断）の応答
+  updated_at = Column(Float, nullable=True)  # 内容を最後に保存した時刻（time.time()）
+
+  __table_args__ = (
+    Index('ix_messages_chat_id_id', 'chat_id', 'id'),
+  )
 
 class models(Base):
   __tablename__ = 'models'
@@ -25,72 +45,288 @@ class models(Base):
   name = Column(String)
   display = Column(String)
   image = Column(Boolean, default=False)
+  reasoning = Column(Boolean, default=False)  # 推論過程を出力するモデルか
+  context_tokens = Column(Integer, nullable=True)  # 履歴に使うトークン予算（未設定ならデフォルト）
+
+class cache_versions(Base):
+  # ワーカー間で共有するキャッシュの世代番号（更新したトランザクション内で加算する）
+  __tablename__ = 'cache_versions'
+  name = Column(String, primary_key=True)
+  version = Column(Integer, default=0)
+
+engine = create_engine(
+  DATABASE_URL,
+  connect_args={"check_same_thread": False},
+  pool_size=10,
+  max_overflow=20,
+  pool_timeout=30,
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+  if engine.dialect.name != "sqlite":
+    return
+  cursor = dbapi_connection.cursor()
+  # WALなら書き込み中も他のワーカーが読み込め、書き込み同士はbusy_timeoutまで待ち合わせる
+  cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+  cursor.execute("PRAGMA journal_mode=WAL")
+  cursor.execute("PRAGMA synchronous=NORMAL")
+  cursor.close()
+
+def get_cache_version(db: Session, name: str) -> int:
+  return db.query(cache_versions.version).filter(cache_versions.name == name).scalar() or 0
+
+def bump_cache_version(db: Session, name: str):
+  """キャッシュの世代を進める（コミットは呼び出し側で行う）"""
+  db.execute(
+    text("INSERT INTO cache_versions (name, version) VALUES (:name, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1"),
+    {"name": name},
+  )
+
+# サイドバー用のチャット一覧のプロセス内キャッシュ（モデル一覧は model_registry が保持する）
+# ORMオブジェクトはセッション終了後に参照できないため、値はnamedtupleで保持する
+# 他のワーカーでの更新も反映するよう、DBの世代番号が変わったら読み直す
+ChatSummary = namedtuple("ChatSummary", ["id", "title"])
+SIDEBAR_CACHE = "sidebar"
+_sidebar_cache = {}
+_sidebar_cache_lock = threading.Lock()
+sidebar_cache_stats = {"hits": 0, "misses": 0}
+
+def _cached(db: Session, key: str, loader):
+  # 世代番号を先に読むため、読み込み中に更新されても次回には読み直される
+  version = get_cache_version(db, SIDEBAR_CACHE)
+  with _sidebar_cache_lock:
+    cached = _sidebar_cache.get(key)
+    if cached is not None and cached[0] == version:
+      sidebar_cache_stats["hits"] += 1
+      return cached[1]
+    sidebar_cache_stats["misses"] += 1
+  value = loader()
+  with _sidebar_cache_lock:
+    _sidebar_cache[key] = (version, value)
+  return value
+
+def invalidate_sidebar_cache(db: Session):
+  """全ワーカーのサイドバーキャッシュを無効にする（コミットは呼び出し側で行う）"""
+  bump_cache_version(db, SIDEBAR_CACHE)
 
 def get_engine():
-  return create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-  
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=get_engine())
+  return engine
+
+def get_db():
+  """リクエスト単位のセッションを提供するFastAPI依存関数"""
+  db: Session = SessionLocal()
+  try:
+    yield db
+  finally:
+    db.close()
+
+def estimate_tokens(text: str) -> int:
+  """トークナイザを使わずにトークン数を見積もる（ASCIIは約4文字、それ以外は約1文字で1トークン）"""
+  if not text:
+    return 0
+  ascii_chars = sum(1 for ch in text if ch.isascii())
+  return (ascii_chars + 3) // 4 + (len(text) - ascii_chars) + 4
+
+def _add_missing_columns():
+  # create_allは既存テーブルに列を追加しないため、足りない列をALTER TABLEで追加する
+  inspector = inspect(engine)
+  with engine.begin() as conn:
+    for table in Base.metadata.sorted_tables:
+      existing = {column["name"] for column in inspector.get_columns(table.name)}
+      for column in table.columns:
+        if column.name not in existing:
+          column_type = column.type.compile(dialect=engine.dialect)
+          conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
 
 def create_db_and_tables():
-  engine = get_engine()
   Base.metadata.create_all(bind=engine)
+  _add_missing_columns()
+  # create_allは既存テーブルにインデックスを追加しないため個別に作成する
+  for index in messages.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+  if engine.dialect.name == "sqlite":
+    raw = engine.raw_connection()
+    try:
+      moved = migrate_sqlite_blobs(raw.driver_connection, ImageStore())
+    finally:
+      raw.close()
+    if moved:
+      print(f"{moved}件の画像をファイルに移しました")
 
-def save_chat_and_message(chat_id: str, title: str, role: str, content: str, image: bytes = None, model_id: int = 1):
-  db: Session = SessionLocal()
-  db_chat = db.query(chats).filter(chats.id == chat_id).first()
-  if not db_chat:
-    db_chat = chats(id=chat_id, title=title)
+def save_chat_and_message(db: Session, chat_id: str, title: str, role: str, content: str, image: bytes = None, model_id: int = 1, title_pending: bool = False):
+  db_chat = db.get(chats, chat_id)
+  if db_chat is None:
+    db_chat = chats(id=chat_id, title=title, title_pending=title_pending)
     db.add(db_chat)
-    db.commit()
-    db.refresh(db_chat)
+    invalidate_sidebar_cache(db)
 
   # Always insert the message
-  db_message = messages(chat_id=chat_id, role=role, content=content, image=image, model_id=model_id)
+  image_hash = ImageStore().put(image) if image else None
+  db_message = messages(chat_id=chat_id, role=role, content=content, image_hash=image_hash, model_id=model_id, tokens=estimate_tokens(content))
   db.add(db_message)
   db.commit()
-  db.refresh(db_message)
-  db.close()
   return db_chat, db_message
 
-def load_chats():
-  db: Session = SessionLocal()
-  chs = db.query(chats).order_by(chats.id.desc()).all()
-  db.close()
-  return chs
+def add_message(db: Session, chat_id: str, role: str, content: str, model_id: int = 1, is_partial: bool = False) -> int:
+  """既存チャットにメッセージを追加し、そのIDを返す"""
+  db_message = messages(chat_id=chat_id, role=role, content=content, model_id=model_id, tokens=estimate_tokens(content), is_partial=is_partial, updated_at=time.time())
+  db.add(db_message)
+  db.flush()
+  message_id = db_message.id
+  db.commit()
+  return message_id
 
-def load_messages(chat_id: str):
-  db: Session = SessionLocal()
-  msgs = db.query(messages).filter(messages.chat_id == chat_id).all()
-  db.close()
+def update_message_content(db: Session, message_id: int, content: str, is_partial: bool = False):
+  db.query(messages).filter(messages.id == message_id).update(
+    {"content": content, "tokens": estimate_tokens(content), "is_partial": is_partial, "updated_at": time.time()},
+    synchronize_session=False,
+  )
+  db.commit()
+
+def load_latest_reply(db: Session, chat_id: str) -> dict:
+  """最後のユーザー発言に対する推論過程と応答の保存済みテキスト、保存途中かどうかを返す"""
+  last_user_id = db.query(func.max(messages.id)).filter(messages.chat_id == chat_id, messages.role == "user").scalar() or 0
+  rows = db.query(messages.role, messages.content, messages.is_partial).filter(
+    messages.chat_id == chat_id,
+    messages.role.in_(("reasoning", "assistant")),
+    messages.id > last_user_id,
+  ).order_by(messages.id).all()
+  reply = {"reasoning": "", "content": "", "partial": False}
+  for role, content, is_partial in rows:
+    reply["content" if role == "assistant" else "reasoning"] = content or ""
+    reply["partial"] = reply["partial"] or bool(is_partial)
+  return reply
+
+def load_chats(db: Session):
+  def loader():
+    rows = db.query(chats.id, chats.title).order_by(chats.id.desc()).all()
+    return tuple(ChatSummary(*row) for row in rows)
+  return _cached(db, "chats", loader)
+
+def load_messages(db: Session, chat_id: str, before_id: int = None, limit: int = None):
+  """チャットのメッセージを古い順に返す。limit指定時はbefore_idより前の最新limit件"""
+  query = db.query(messages).filter(messages.chat_id == chat_id)
+  if before_id is not None:
+    query = query.filter(messages.id < before_id)
+  if limit is None:
+    return query.order_by(messages.id).all()
+  msgs = query.order_by(messages.id.desc()).limit(limit).all()
+  msgs.reverse()
   return msgs
 
-def delete_chat(chat_id: str):
-  db: Session = SessionLocal()
+def load_message_page(db: Session, chat_id: str, before_id: int = None, limit: int = MESSAGE_PAGE_SIZE):
+  """1ページ分のメッセージと、それより古いメッセージが残っているかを返す"""
+  msgs = load_messages(db, chat_id, before_id=before_id, limit=limit + 1)
+  has_older = len(msgs) > limit
+  if has_older:
+    msgs = msgs[1:]
+  return msgs, has_older
+
+def is_reply_streaming(db: Session, chat_id: str, within: float) -> bool:
+  """最後のメッセージが保存途中で、within秒以内に更新されていれば（どこかのワーカーがストリーミング中なら）Trueを返す"""
+  row = db.query(messages.is_partial, messages.updated_at).filter(messages.chat_id == chat_id).order_by(messages.id.desc()).first()
+  return bool(row and row.is_partial and row.updated_at and time.time() - row.updated_at < within)
+
+def load_chat_page(db: Session, chat_id: str):
+  """チャット画面の描画に必要なデータを1つのセッション・トランザクションでまとめて取得する"""
+  chat = db.get(chats, chat_id)
+  if chat is None:
+    return None
+  msgs, has_older = load_message_page(db, chat_id)
+  return {
+    "title": chat.title,
+    "title_pending": bool(chat.title_pending),
+    "messages": msgs,
+    "has_older": has_older,
+    "chats": load_chats(db),
+    "models": get_models(),
+  }
+
+def update_chat_title(db: Session, chat_id: str, title: str):
+  db.query(chats).filter(chats.id == chat_id).update({"title": title, "title_pending": False}, synchronize_session=False)
+  invalidate_sidebar_cache(db)
+  db.commit()
+
+def delete_chat(db: Session, chat_id: str):
   db.query(messages).filter(messages.chat_id == chat_id).delete()
   db.query(chats).filter(chats.id == chat_id).delete()
+  invalidate_sidebar_cache(db)
   db.commit()
-  db.close()
 
-def chat_exists(chat_id: str) -> bool:
-  db: Session = SessionLocal()
-  exists = db.query(chats).filter(chats.id == chat_id).first() is not None
-  db.close()
-  return exists
+def chat_exists(db: Session, chat_id: str) -> bool:
+  return db.get(chats, chat_id) is not None
 
-def get_chat_title(chat_id: str) -> str:
-  db: Session = SessionLocal()
-  chat = db.query(chats).filter(chats.id == chat_id).first()
-  db.close()
+def get_chat_title(db: Session, chat_id: str) -> str:
+  chat = db.get(chats, chat_id)
   return chat.title if chat else "Untitled Chat"
 
-def get_models():
-    db: Session = SessionLocal()
-    models_list = db.query(models).all()
+def is_title_pending(db: Session, chat_id: str) -> bool:
+  chat = db.get(chats, chat_id)
+  return bool(chat and chat.title_pending)
+
+def _load_model_rows():
+  db: Session = SessionLocal()
+  try:
+    rows = db.query(models.id, models.name, models.display, models.image, models.reasoning, models.context_tokens).all()
+  finally:
     db.close()
-    return models_list
+  return [
+    ModelInfo(id=row.id, name=row.name, display=row.display, image=bool(row.image), reasoning=bool(row.reasoning), context_tokens=row.context_tokens)
+    for row in rows
+  ]
+
+# 起動時に一度だけ読み込むモデルカタログ（modelsテーブル更新後は reload_model_catalog() を呼ぶ）
+MODEL_CATALOG = "models"
+model_registry = ModelRegistry(_load_model_rows)
+_model_catalog_version = None
 
-def get_model_from_id(model_id: int):
-    db: Session = SessionLocal()
-    model = db.query(models).filter(models.id == model_id).first()
+def sync_model_registry() -> bool:
+  """他のワーカーがカタログを更新していればレジストリを読み直す"""
+  global _model_catalog_version
+  db: Session = SessionLocal()
+  try:
+    version = get_cache_version(db, MODEL_CATALOG)
+  finally:
+    db.close()
+  if version == _model_catalog_version:
+    return False
+  model_registry.reload()
+  _model_catalog_version = version
+  return True
+
+def reload_model_catalog():
+  """modelsテーブルの更新を全ワーカーに知らせ、このワーカーのレジストリを読み直す"""
+  db: Session = SessionLocal()
+  try:
+    bump_cache_version(db, MODEL_CATALOG)
+    db.commit()
+  finally:
     db.close()
-    return model.name if model else "meta-llama/llama-4-maverick-17b-128e-instruct"
\ No newline at end of file
+  sync_model_registry()
+
+def get_models():
+  return model_registry.all()
+
+def get_model(model_id: int):
+  return model_registry.get(model_id)
+
+def load_context_messages(db: Session, chat_id: str, after_id: int = 0, until_id: int = None):
+  """コンテキスト組み立て用に、推論過程と画像を除いたメッセージを古い順に返す"""
+  query = db.query(messages.id, messages.role, messages.content, messages.tokens).filter(
+    messages.chat_id == chat_id,
+    messages.role != "reasoning",
+    messages.id > after_id,
+  )
+  if until_id is not None:
+    query = query.filter(messages.id <= until_id)
+  return query.order_by(messages.id).all()
+
+def update_chat_summary(db: Session, chat_id: str, summary: str, until_id: int):
+  # 並行して走った古い要約で上書きしないよう、範囲が進む場合のみ更新する
+  db.query(chats).filter(
+    chats.id == chat_id,
+    chats.summary_until_id.is_(None) | (chats.summary_until_id < until_id),
+  ).update({"summary": summary, "summary_until_id": until_id}, synchronize_session=False)
+  db.commit()
@@ -0,0 +1,64 @@
+"""Streamlitページで共有するDB接続とAPIクライアント
+
+st.cache_resource でプロセスごとに一度だけ作成し、再実行のたびにDDL・
+クライアント（HTTP接続プール）を作り直さないようにする。
+DB接続はセッションごとに1つ持つ（1つの接続を複数のセッションで共有すると、
+あるセッションのcommitが別のセッションの書き込み途中の変更まで確定してしまうため）。
+"""
+import sqlite3
+import streamlit as st
+from groq import Groq
+from google import genai
+from openai import OpenAI
+from image_store import ImageStore, migrate_sqlite_blobs
+from sqlite_settings import SQLITE_PRAGMAS
+
+@st.cache_resource
+def get_image_store():
+    return ImageStore()
+
+def _connect(database_name: str) -> sqlite3.Connection:
+    # セッションの再実行は毎回別のスレッドで動くため、スレッドの確認はしない（同時に使うのは1スレッドだけ）
+    conn = sqlite3.connect(database_name, check_same_thread=False)
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+@st.cache_resource
+def _prepare_database(database_name: str, schema: str = ""):
+    """schemaのDDLと画像BLOBの移行を、プロセスで最初の1回だけ実行する"""
+    conn = _connect(database_name)
+    try:
+        if schema:
+            conn.executescript(schema)
+            conn.commit()
+        moved = migrate_sqlite_blobs(conn, get_image_store())
+        if moved:
+            print(f"{database_name}: {moved}件の画像をファイルに移しました")
+    finally:
+        conn.close()
+    return True
+
+def get_connection(database_name: str, schema: str = ""):
+    """このセッション用の、WALを有効にした接続を返す"""
+    _prepare_database(database_name, schema)
+    connections = st.session_state.setdefault("db_connections", {})
+    conn = connections.get(database_name)
+    if conn is None:
+        conn = connections[database_name] = _connect(database_name)
+    elif conn.in_transaction:
+        # 前回の実行が例外で止まり、途中までの変更が残っていれば取り消す
+        conn.rollback()
+    return conn
+
+@st.cache_resource
+def get_groq_client():
+    return Groq()
+
+@st.cache_resource
+def get_genai_client():
+    return genai.Client()
+
+@st.cache_resource
+def get_openai_client():
+    return OpenAI()
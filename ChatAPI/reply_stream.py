@@ -0,0 +1,57 @@
+"""複数モデルの応答ストリームを並行して受け取る
+
+各ストリームは別スレッドで読み、差分をキューに積む。Streamlitの要素はスクリプトの
+スレッドからしか更新できないため、描画は呼び出し側が fan_out() の結果を順に受け取って行う。
+全体の待ち時間は、最も遅いモデルの応答時間になる。
+"""
+import time
+import queue
+import threading
+from collections import namedtuple
+
+# ttft: 送信から最初の差分までの秒数、tokens_per_sec: 最初の差分以降の出力速度
+ReplyStats = namedtuple("ReplyStats", ["ttft", "tokens", "tokens_per_sec"])
+
+def _read_stream(index, stream, out):
+    """stream() が返す (role, 差分) を読み、最後に ("done", ReplyStats) か ("error", 例外) を積む"""
+    start = time.perf_counter()
+    first = None
+    chunks = 0
+    usage = None
+    try:
+        for role, delta in stream():
+            if role == "usage":  # APIが返した出力トークン数
+                usage = delta
+                continue
+            if not delta:
+                continue
+            if first is None:
+                first = time.perf_counter()
+            chunks += 1
+            out.put((index, role, delta))
+    except Exception as e:
+        out.put((index, "error", e))
+        return
+    end = time.perf_counter()
+    tokens = usage or chunks  # トークン数が返らないAPIではチャンク数で代用する
+    if first is None:
+        stats = ReplyStats(None, 0, None)
+    else:
+        stats = ReplyStats(first - start, tokens, tokens / (end - first) if end > first else None)
+    out.put((index, "done", stats))
+
+def fan_out(streams):
+    """各ストリームを別スレッドで開始し、(番号, 種類, 値) を届いた順に返す
+
+    種類は stream() が返すrole（"assistant"・"reasoning"など）と、各ストリームの最後に1回ずつ
+    届く "done"（値はReplyStats）または "error"（値は例外）。
+    """
+    out = queue.Queue()
+    for index, stream in enumerate(streams):
+        threading.Thread(target=_read_stream, args=(index, stream, out), daemon=True).start()
+    remaining = len(streams)
+    while remaining:
+        item = out.get()
+        if item[1] in ("done", "error"):
+            remaining -= 1
+        yield item
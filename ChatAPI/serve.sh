@@ -0,0 +1,11 @@
+#!/bin/sh
+# CHATAPI_ENV=production のときはリロード監視なしの複数ワーカーで起動し、それ以外は開発用に --reload で起動する
+set -e
+
+if [ "$CHATAPI_ENV" = "production" ]; then
+  # ワーカーが同時にスキーマを変更しないよう、起動前に一度だけテーブルを作成しておく
+  uv run python -c "import models; models.create_db_and_tables()"
+  exec uv run uvicorn app:app --host 0.0.0.0 --port "${PORT:-8501}" --workers "${WEB_CONCURRENCY:-4}" --no-access-log
+fi
+
+exec uv run uvicorn app:app --reload
@@ -0,0 +1,11 @@
+"""StreamlitページとバックグラウンドのワーカーでSQLiteの接続に共通して設定するPRAGMA
+
+page_resources（Streamlit・各SDKを読み込む）と image_jobs の両方から使うため、ほかのモジュールには依存しない。
+"""
+
+# 同じDBファイルを複数のセッション（スレッド）から使うための設定
+SQLITE_PRAGMAS = (
+    "PRAGMA busy_timeout=15000",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+)
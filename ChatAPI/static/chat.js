@@ -48,7 +48,63 @@ function appendMessage(content, role='assistant'){
   return rendered; // 返り値でレンダリング要素を渡し、ストリーミング更新を可能にする
 }
 
-document.querySelectorAll('.message-item').forEach(item => {
+// assistant メッセージの直前に思考過程の表示欄を追加し、本文の要素を返す
+function appendReasoning(assistantRendered){
+  const details = document.createElement('details');
+  details.className = 'mt-2 small text-secondary';
+  const summary = document.createElement('summary');
+  summary.textContent = '思考過程を表示';
+  const body = document.createElement('p');
+  body.className = 'text-break';
+  details.appendChild(summary);
+  details.appendChild(body);
+  assistantRendered.closest('.message-item').before(details);
+  return body;
+}
+
+function renderMarkdown(target, md){
+  if (typeof marked !== 'undefined') {
+    const html = marked.parse(md);
+    target.innerHTML = (typeof DOMPurify !== 'undefined') ? DOMPurify.sanitize(html) : html;
+  } else {
+    target.textContent = md;
+  }
+}
+
+// SSEを読み取り、イベントごとに onEvent({ event, data, id }) を呼ぶ（ハートビートのコメント行は無視）
+async function readEventStream(res, onEvent){
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf('\n\n')) !== -1) {
+      const frame = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      const message = { event: 'message', data: [], id: null };
+      for (const line of frame.split('\n')) {
+        if (!line || line.startsWith(':')) continue;
+        const idx = line.indexOf(':');
+        const field = idx === -1 ? line : line.slice(0, idx);
+        let val = idx === -1 ? '' : line.slice(idx + 1);
+        if (val.startsWith(' ')) val = val.slice(1);
+        if (field === 'data') message.data.push(val);
+        else if (field === 'event') message.event = val;
+        else if (field === 'id') message.id = val;
+      }
+      if (message.data.length) onEvent({ event: message.event, data: message.data.join('\n'), id: message.id });
+    }
+  }
+}
+
+function renderSavedMessages(root){
+  root.querySelectorAll('.message-item').forEach(renderSavedMessage);
+}
+
+function renderSavedMessage(item){
   const raw = item.querySelector('.raw-markdown');
   const target = item.querySelector('.rendered-markdown');
   const role = item.getAttribute('data-role');
@@ -66,12 +122,69 @@ document.querySelectorAll('.message-item').forEach(item => {
   } finally {
     raw.remove();
   }
-});
+}
+
+renderSavedMessages(document);
 
 // ページ読み込み時にメッセージエリアを最下部にスクロール
 const chatMain = document.querySelector('.chat-main');
 if (chatMain && chatMain.scrollHeight > chatMain.clientHeight) chatMain.scrollTop = chatMain.scrollHeight;
 
+// ストリーミング中の応答は、保存済みの内容を再取得して追従する（中断されたまま残った応答には追従しない）
+const messageItems = document.querySelectorAll('.message-item');
+const lastItem = messageItems[messageItems.length - 1];
+if (lastItem && lastItem.dataset.partial === 'true' && document.body.dataset.replyStreaming === 'true') {
+  (async () => {
+    const res = await fetch(`${window.location.pathname}/resume`);
+    if (!res.ok) return;
+    const target = lastItem.querySelector('.rendered-markdown');
+    let replayed = '';
+    await readEventStream(res, (msg) => {
+      if (msg.event !== 'content') return;
+      replayed += msg.data;
+      renderMarkdown(target, replayed);
+    });
+  })();
+}
+
+// タイトル生成待ちのチャットは、生成されるまでポーリングしてページとサイドバーに反映
+if (document.body.dataset.titlePending === 'true') {
+  const chatPath = window.location.pathname;
+  (async () => {
+    for (let i = 0; i < 10; i++) {
+      await new Promise(resolve => setTimeout(resolve, 1000));
+      const res = await fetch(`${chatPath}/title`);
+      if (!res.ok) return;
+      const { title, pending } = await res.json();
+      document.title = title;
+      const link = document.querySelector(`#sidebarOffcanvas a[href="${chatPath}"]`);
+      if (link) link.textContent = title;
+      if (!pending) return;
+    }
+  })();
+}
+
+// 以前のメッセージを読み込んで先頭に挿入（スクロール位置は維持）
+if (chatMain) {
+  chatMain.addEventListener('click', async (e) => {
+    const btn = e.target.closest('.load-older button');
+    if (!btn) return;
+    btn.disabled = true;
+    const res = await fetch(`${window.location.pathname}/messages?before_id=${btn.dataset.beforeId}`);
+    if (!res.ok) {
+      btn.disabled = false;
+      return;
+    }
+    const template = document.createElement('template');
+    template.innerHTML = await res.text();
+    renderSavedMessages(template.content);
+
+    const prevHeight = chatMain.scrollHeight;
+    btn.closest('.load-older').replaceWith(template.content);
+    chatMain.scrollTop += chatMain.scrollHeight - prevHeight;
+  });
+}
+
 const chatForm = document.getElementById('chat-form');
 if (chatForm) {
   chatForm.addEventListener('submit', async (e) => {
@@ -94,25 +207,44 @@ if (chatForm) {
       body: new URLSearchParams({ user_input, model_select: model_select.value })
     });
 
-    const reader = res.body.getReader();
-    const decoder = new TextDecoder();
     let assistantAccum = '';
+    let reasoningAccum = '';
+    let reasoningBody = null;
+    let lastEventId = null;
+    let finished = false;
     // まず空の assistant メッセージを追加して要素を取得
     const assistantRendered = appendMessage('', 'assistant');
 
-    while (true) {
-      const { done, value } = await reader.read();
-      if (done) break;
-      const chunk = decoder.decode(value, { stream: true });
-      assistantAccum += chunk;
-
-      if (typeof marked !== 'undefined') {
-        const html = marked.parse(assistantAccum);
-        assistantRendered.innerHTML = (typeof DOMPurify !== 'undefined') ? DOMPurify.sanitize(html) : html;
-      } else {
-        assistantRendered.textContent = assistantAccum;
+    const onEvent = (msg) => {
+      if (msg.id) lastEventId = msg.id;
+      if (msg.event === 'reasoning') {
+        if (!reasoningBody) reasoningBody = appendReasoning(assistantRendered);
+        reasoningAccum += msg.data;
+        reasoningBody.textContent = reasoningAccum;
+      } else if (msg.event === 'content') {
+        assistantAccum += msg.data;
+        renderMarkdown(assistantRendered, assistantAccum);
+      } else if (msg.event === 'done') {
+        finished = true;
       }
       chatMain.scrollTop = chatMain.scrollHeight;
+    };
+
+    const streamChatId = res.headers.get('X-Chat-Id');
+    try {
+      await readEventStream(res, onEvent);
+    } catch (err) {
+      console.warn('Stream interrupted:', err);
+    }
+    // 途中で切れた場合は Last-Event-ID を付けて続きから再取得
+    for (let retry = 0; !finished && streamChatId && retry < 3; retry++) {
+      try {
+        const headers = lastEventId ? { 'Last-Event-ID': lastEventId } : {};
+        const resumed = await fetch(`/c/${streamChatId}/resume`, { headers });
+        if (resumed.ok) await readEventStream(resumed, onEvent);
+      } catch (err) {
+        console.warn('Resume failed:', err);
+      }
     }
 
     try {
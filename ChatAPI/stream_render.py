@@ -0,0 +1,89 @@
+"""ストリーミング応答の描画をまとめるStreamlit用のレンダラー
+
+チャンクごとに全文を placeholder.markdown() し直すと、長い応答では描画と
+WebSocketの転送量が文字数の2乗で増える。StreamRenderer は受け取った差分を溜めて
+interval 秒ごとにだけ描画し、段落（コードブロックの外の空行）で区切れた部分は
+確定した要素として残して、以降は未確定の末尾だけを送り直す。
+空行をまたいで続くMarkdown（入れ子・ゆるいリスト、脚注、参照形式のリンク）は要素を分けると
+崩れるため、次の段落が字下げ・リスト・[ で始まるときは区切らず、最後の flush() で全文を1つの要素に描き直す。
+free_chat.py と task/qa.py で共有する。
+"""
+import re
+import time
+
+STREAM_RENDER_INTERVAL = 0.08  # 描画の最短間隔（秒）
+_FENCE = "```"
+# 前の段落の続きになりうる段落の書き出し（字下げ・リスト項目・脚注や参照形式のリンクの定義）
+# （書き出しが届ききっておらず判定できないものも、続きが来るまで区切らない）
+_CONTINUATION = re.compile(r"[ \t]|[-*+](?:[ \t]|$)|\d+(?:[.)](?:[ \t]|$)|$)|\[")
+
+def _block_boundary(text: str, start: int) -> int:
+    """start以降で最後の、コードブロックの外にあり前の段落と独立した段落区切りの直後の位置を返す（なければstart）"""
+    pos = text.rfind("\n\n", start)
+    while pos >= start:
+        # start より前のコードブロックは閉じているため、start からのフェンス数で判定できる
+        following = text[pos:].lstrip("\n")
+        if text.count(_FENCE, start, pos) % 2 == 0 and following and not _CONTINUATION.match(following):
+            return pos + 2
+        pos = text.rfind("\n\n", start, pos)
+    return start
+
+class StreamRenderer:
+    """差分を追記していき、間隔を空けて container に描画する"""
+
+    def __init__(self, container, method: str = "markdown", interval: float = STREAM_RENDER_INTERVAL, clock=time.monotonic):
+        self.container = container
+        self.method = method  # "markdown" や "caption" など、要素を描画するメソッド名
+        self.interval = interval
+        self.clock = clock
+        self.text = ""
+        self._frozen = 0  # 確定した要素として描画済みの文字数
+        self._rendered = 0
+        self._last_render = None
+        self._tail = None  # 未確定の末尾を描画しているプレースホルダー
+        self._placeholders = []  # 描画に使ったプレースホルダー（確定した要素と末尾）
+
+    def write(self, delta):
+        """差分を追加する（Noneや空文字は無視する）"""
+        if not delta:
+            return
+        self.text += delta
+        now = self.clock()
+        if self._last_render is None or now - self._last_render >= self.interval:
+            self._update(now)
+
+    def flush(self):
+        """ストリームの最後に呼び、全文を1つの要素に描き直す（エラーで途中終了したときも呼ぶ）"""
+        if not self.text or (self._frozen == 0 and self._rendered == len(self.text)):
+            return
+        if not self._placeholders:
+            self._placeholders.append(self.container.empty())
+        first, *rest = self._placeholders
+        getattr(first, self.method)(self.text)
+        for placeholder in rest:
+            placeholder.empty()
+        self._placeholders = [first]
+        self._tail = first
+        self._frozen = 0
+        self._rendered = len(self.text)
+        self._last_render = self.clock()
+
+    def _update(self, now):
+        if self._rendered == len(self.text):
+            return
+        boundary = _block_boundary(self.text, self._frozen)
+        if boundary > self._frozen:
+            # 区切りまでを今のプレースホルダーに書いて確定させ、続きは新しい要素に描く
+            self._render(self.text[self._frozen:boundary].rstrip("\n"))
+            self._tail = None
+            self._frozen = boundary
+        if len(self.text) > self._frozen:
+            self._render(self.text[self._frozen:])
+        self._rendered = len(self.text)
+        self._last_render = now
+
+    def _render(self, text: str):
+        if self._tail is None:
+            self._tail = self.container.empty()
+            self._placeholders.append(self._tail)
+        getattr(self._tail, self.method)(text)
@@ -0,0 +1,170 @@
+"""ストリーミング応答の逐次保存・SSE送信・再送
+
+応答は受信したチャンクをまとめて、FLUSH_CHUNKS個ごと、またはFLUSH_INTERVAL秒ごとに
+1つのメッセージ行へ上書き保存する。切断やワーカー再起動で途中までの応答が失われず、
+resume_reply()で保存済みの内容を再送できる。
+
+クライアントへは encode_sse() で reasoning / content / done のSSEイベントとして送る。
+イベントIDは「送信済みの推論文字数:応答文字数」で、Last-Event-IDから続きを再送できる。
+"""
+import time
+import anyio
+import asyncio
+import models
+
+FLUSH_CHUNKS = 32
+FLUSH_INTERVAL = 0.5
+COALESCE_INTERVAL = 0.05
+COALESCE_BYTES = 1024
+HEARTBEAT_INTERVAL = 15
+# 別のワーカーで生成中の応答は、この秒数更新がなければ中断されたとみなす
+STALE_STREAM_TIMEOUT = 5
+HEARTBEAT = ": keepalive\n\n"
+# nginxのバッファリングを無効にし、フレームをすぐにクライアントへ届ける
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+EVENT_TYPES = ("reasoning", "content")
+
+# このプロセスでストリーミング中のチャットID（他のワーカーの分は is_partial と更新の有無で判断する）
+active_streams = set()
+
+class PartialMessage:
+    """ストリーミング中の出力を1行にまとめて逐次保存する"""
+
+    def __init__(self, db, chat_id: str, role: str, model_id: int):
+        self.db = db
+        self.chat_id = chat_id
+        self.role = role
+        self.model_id = model_id
+        self.message_id = None
+        self.parts = []
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def append(self, text: str):
+        if text:
+            self.parts.append(text)
+            self.pending += 1
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def should_flush(self) -> bool:
+        if not self.pending:
+            return False
+        return self.pending >= FLUSH_CHUNKS or time.monotonic() - self.last_flush >= FLUSH_INTERVAL
+
+    async def flush(self, is_partial: bool = True):
+        if self.message_id is None and not self.parts:
+            return
+        content = self.text
+        if self.message_id is None:
+            self.message_id = await asyncio.to_thread(models.add_message, self.db, self.chat_id, self.role, content, self.model_id, is_partial)
+        else:
+            await asyncio.to_thread(models.update_message_content, self.db, self.message_id, content, is_partial)
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+def format_sse(data: str, event: str = None, event_id: str = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    for line in data.split("\n"):
+        lines.append(f"data: {line}")
+    return "\n".join(lines) + "\n\n"
+
+def parse_last_event_id(value: str) -> dict:
+    """Last-Event-ID（推論文字数:応答文字数）を送信済みオフセットに変換する"""
+    try:
+        reasoning, content = (int(v) for v in value.split(":"))
+        return {"reasoning": max(reasoning, 0), "content": max(content, 0)}
+    except (AttributeError, ValueError):
+        return {"reasoning": 0, "content": 0}
+
+async def encode_sse(events, offsets: dict = None):
+    """(イベント種別, テキスト) の非同期イテレータをSSEフレームに変換する
+
+    細かいトークンはCOALESCE_INTERVAL秒またはCOALESCE_BYTESまでまとめて1フレームにし、
+    上流が無通信の間はHEARTBEAT_INTERVAL秒ごとにコメント行を送る。
+    次のチャンクは送信が終わってから要求するため、遅いクライアントには上流の読み取りも遅れる。
+    """
+    loop = asyncio.get_running_loop()
+    iterator = events.__aiter__()
+    sent = dict(offsets or {"reasoning": 0, "content": 0})
+    buffers = {event: [] for event in EVENT_TYPES}
+    buffered_bytes = 0
+    deadline = None
+    pending = None
+
+    def flush():
+        nonlocal buffered_bytes, deadline
+        frames = []
+        for event in EVENT_TYPES:
+            if buffers[event]:
+                text = "".join(buffers[event])
+                buffers[event].clear()
+                sent[event] += len(text)
+                frames.append(format_sse(text, event=event, event_id=f"{sent['reasoning']}:{sent['content']}"))
+        buffered_bytes = 0
+        deadline = None
+        return "".join(frames)
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = HEARTBEAT_INTERVAL if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                yield flush() if deadline is not None else HEARTBEAT
+                continue
+            future, pending = pending, None
+            try:
+                event, text = future.result()
+            except StopAsyncIteration:
+                break
+            if not text:
+                continue
+            buffers[event].append(text)
+            buffered_bytes += len(text.encode())
+            if deadline is None:
+                deadline = loop.time() + COALESCE_INTERVAL
+            if buffered_bytes >= COALESCE_BYTES:
+                yield flush()
+        frames = flush()
+        yield frames + format_sse("", event="done", event_id=f"{sent['reasoning']}:{sent['content']}")
+    finally:
+        # 切断時は読み取り中の上流を止め、元のジェネレータの後始末を完了させる
+        with anyio.CancelScope(shield=True):
+            if pending is not None:
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+            await iterator.aclose()
+
+def _load_latest_reply(chat_id: str):
+    db = models.SessionLocal()
+    try:
+        return models.load_latest_reply(db, chat_id)
+    finally:
+        db.close()
+
+async def resume_reply(chat_id: str, offsets: dict):
+    """保存済みの応答をoffsets以降から再送し、まだストリーミング中なら完了まで追従する"""
+    loop = asyncio.get_running_loop()
+    sent = dict(offsets)
+    last_update = loop.time()
+    while True:
+        # 読み込み前に判定し、完了直前に保存された分も必ず送る
+        streaming = chat_id in active_streams
+        reply = await asyncio.to_thread(_load_latest_reply, chat_id)
+        for event in EVENT_TYPES:
+            text = reply[event]
+            if len(text) > sent[event]:
+                yield event, text[sent[event]:]
+                sent[event] = len(text)
+                last_update = loop.time()
+        if not streaming and not (reply["partial"] and loop.time() - last_update < STALE_STREAM_TIMEOUT):
+            return
+        await asyncio.sleep(FLUSH_INTERVAL)
@@ -1,5 +1,6 @@
 import streamlit as st
-from groq import Groq
+from page_resources import get_groq_client
+from stream_render import StreamRenderer
 
 st.title("一問一答")
 task_name = st.segmented_control("タスク", options=["翻訳", "要約"], default="翻訳", label_visibility="collapsed")
@@ -12,7 +13,7 @@ st.set_page_config(
 )
 st.header(task_name)
 
-client = Groq()
+client = get_groq_client()
 
 with st.form("task_form"):
     system_prompt = f"ユーザーから与えられた文章を要約してください。\n要約した文章のみを出力してください。"
@@ -49,11 +50,10 @@ if user_input:
         temperature=0,
         stream=True,
     )
-    response_placeholder = message.empty()
-    response_text = ""
+    renderer = StreamRenderer(message)
     for chunk in response:
         if chunk.choices[0].finish_reason != 'stop':
-            response_text += chunk.choices[0].delta.content
-            response_placeholder.markdown(response_text)
+            renderer.write(chunk.choices[0].delta.content)  # 役割だけのチャンクなどではNone
+    renderer.flush()
 else:
     message.write('文章が入力されていません。')
\ No newline at end of file
@@ -0,0 +1,72 @@
+"""生成した音声のディスクキャッシュ
+
+テキスト・ボイス・モデルのハッシュをファイル名にしてWAVを保存し、同じ内容の再生では
+TTS APIを呼ばずにファイルを返す。合計サイズがmax_bytesを超えたら、最後に使われてから
+時間の経ったファイルから削除する（LRU）。free_chat.py と audio/text_to_speech.py で共有する。
+"""
+import os
+import hashlib
+import tempfile
+
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "/data/tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+
+class AudioCache:
+    """ハッシュをキーにした音声ファイルのLRUキャッシュ（最終利用時刻はファイルのmtimeで管理する）"""
+
+    def __init__(self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(model: str, voice: str, content: str) -> str:
+        return hashlib.sha256("\0".join((model, voice, content)).encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.wav")
+
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)  # 使われたファイルを新しい側に移す
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, key: str, data: bytes):
+        # キャッシュに書けなくても音声の再生は続けられるため、エラーはログに残すだけにする
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # 書き込み途中のファイルを他のプロセスが読まないよう、一時ファイルから置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+            self.evict()
+        except OSError as e:
+            print(f"音声キャッシュの保存に失敗: {e}")
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".wav"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size